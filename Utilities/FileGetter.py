@@ -82,7 +82,7 @@ class FileGetter:
         return scale
 
 
-def get_generic_args():
+def get_generic_args(years=(2016, 2017, 2018)):
     parser = argparse.ArgumentParser()
     parser.add_argument("proc_type", type=str,)
     parser.add_argument("-o", "--outdir", type=str, required=True,
@@ -91,10 +91,63 @@ def get_generic_args():
                         help="Specificy analysis used")
     parser.add_argument("-s", "--selection", type=str, required=True,
                         help="Specificy selection used")
-    parser.add_argument("-c", "--channel", type=str, default="",
-                        help="Channels to run over")
+    parser.add_argument("-c", "--channel", default=[],
+                        type=lambda x : [i.strip() for i in x.split(',') if i.strip()],
+                        help="Channels to run over, comma separated or 'all'. "
+                        "More than one writes one apply output per channel")
     parser.add_argument("-j", type=int, default=1, help="Number of cores")
+    parser.add_argument("--backend", type=str, default="thread",
+                        choices=["thread", "process"],
+                        help="Run the -j workers as threads or processes")
     parser.add_argument("-r", action="store_true", help="Remake create files")
+    parser.add_argument("--shard-size", type=int, default=0,
+                        help="Split files with more entries than this into "
+                        "entry ranges run as separate jobs")
+    parser.add_argument("--year", type=int, default=2016,
+                        choices=list(years),
+                        help="Data taking year, picks the year dependent "
+                        "working points and scale factors")
+    parser.add_argument("--reorder-cuts", action="store_true",
+                        help="Apply cuts cheapest per rejected event first, the "
+                        "cutflow follows the new order")
+    parser.add_argument("--hists-only", action="store_true",
+                        help="Only fill the histograms in apply, no parquet "
+                        "output per channel")
+    parser.add_argument("--prefetch", type=int, default=0,
+                        help="Chunks read ahead on a background thread while "
+                        "the current one is processed")
+    parser.add_argument("--memory-budget", type=int, default=0,
+                        help="Memory in MB for the events of one worker, picks "
+                        "the chunk size from the branch sizes in each file")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only run jobs whose masks are missing from an "
+                        "existing mask file or changed since, and the jobs "
+                        "reading them (implies --fused)")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Directory caching the output of each job per input "
+                        "file, create loads unchanged results from it "
+                        "(implies --fused, unused with --stream or --preskim)")
+    parser.add_argument("--cache-size", type=float, default=0,
+                        help="Size in GB kept in --cache-dir, least recently "
+                        "used results go first (0 keeps everything)")
+    parser.add_argument("--pack-masks", action="store_true",
+                        help="Store the object masks of each collection as one "
+                        "bit-packed integer per object, in memory and in the "
+                        "mask file (implies --fused)")
+    parser.add_argument("--fused", action="store_true",
+                        help="Read each file once for all steps")
+    parser.add_argument("--stream", action="store_true",
+                        help="Write parquet files one chunk at a time "
+                        "(implies --fused)")
+    parser.add_argument("--job-threads", type=int, default=1,
+                        help="Threads running independent jobs of a chunk "
+                        "(with --fused)")
+    parser.add_argument("--prune", action="store_true",
+                        help="Only run jobs the cuts, scale factors and output "
+                        "variables need (implies --fused)")
+    parser.add_argument("--preskim", action="store_true",
+                        help="Only pass events passing the skim cuts on to "
+                        "later jobs (implies --fused)")
     parser.add_argument("-f", "--filenames", required=True,
                         type=lambda x : [i.strip() for i in x.split(',')],
                         help="List of input file names, "
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# Run from the top directory: python -m benchmarks.chunk_buffer
+
+import awkward1 as ak
+import numpy as np
+import time
+
+from python.ChunkBuffer import ChunkBuffer
+
+def make_chunk(nevents, max_objects=6):
+    counts = np.random.randint(0, max_objects, nevents)
+    offsets = np.zeros(nevents+1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    content = np.random.random(offsets[-1]) > 0.5
+    return ak.Array(ak.layout.ListOffsetArray64(ak.layout.Index64(offsets),
+                                                ak.layout.NumpyArray(content)))
+
+def concatenate_accumulate(chunks):
+    output = ak.Array([])
+    for chunk in chunks:
+        output = ak.concatenate([output, chunk])
+    return output
+
+def buffer_accumulate(chunks):
+    output = ChunkBuffer()
+    for chunk in chunks:
+        output.append(chunk)
+    return output.snapshot()
+
+def timeit(func, chunks):
+    begin = time.perf_counter()
+    func(chunks)
+    return time.perf_counter() - begin
+
+if __name__ == "__main__":
+    chunk_size = 10000
+    print("{:>8} {:>14} {:>14} {:>14} {:>14}".format(
+        "nchunks", "concat (s)", "per chunk", "buffer (s)", "per chunk"))
+    for nchunks in [10, 20, 40, 80, 160, 320]:
+        chunks = [make_chunk(chunk_size) for _ in range(nchunks)]
+        t_concat = timeit(concatenate_accumulate, chunks)
+        t_buffer = timeit(buffer_accumulate, chunks)
+        print("{:>8} {:>14.4f} {:>14.6f} {:>14.4f} {:>14.6f}".format(
+            nchunks, t_concat, t_concat/nchunks, t_buffer, t_buffer/nchunks))
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# Run from the top directory: python -m benchmarks.kernels
+# Compares each ported job in its flat buffer form against the ArrayBuilder
+# form it replaced, on the same random events.
+
+import awkward1 as ak
+import numpy as np
+import numba
+import math
+import time
+
+from python.Process import Process
+from python.Common import deltaR, jetRel
+from modules import Electron, Muon, Jet, EventWide
+
+def jagged(counts, content):
+    offsets = np.zeros(len(counts)+1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return ak.Array(ak.layout.ListOffsetArray64(ak.layout.Index64(offsets),
+                                                ak.layout.NumpyArray(content)))
+
+def make_events(nevents):
+    events = dict()
+    sizes = {"Electron": 3, "Muon": 3, "Jet": 9, "GenPart": 40}
+    counts = {coll: np.random.randint(0, size, nevents) for coll, size in sizes.items()}
+    for coll, count in counts.items():
+        total = count.sum()
+        for var, low, high in [("pt", 5, 200), ("eta", -2.5, 2.5), ("phi", -math.pi, math.pi),
+                               ("mass", 0, 10), ("eCorr", 0.9, 1.1)]:
+            events["{}_{}".format(coll, var)] = jagged(
+                count, np.random.uniform(low, high, total).astype(np.float32))
+        events[coll+"_charge"] = jagged(count, np.random.choice([-1, 1], total).astype(np.int32))
+        events[coll+"_scale"] = jagged(count, np.random.uniform(0.9, 1.1, total))
+        # closest jet is the leading one when there is a jet
+        has_jet = np.repeat(counts["Jet"] > 0, count)
+        close = np.stack([np.where(has_jet, 0., -1.),
+                          np.where(has_jet, np.random.uniform(0, 1, total), 10.)], axis=1)
+        events[coll+"_closeJetIndex"] = ak.Array(ak.layout.ListOffsetArray64(
+            events[coll+"_pt"].layout.offsets,
+            ak.layout.RegularArray(ak.layout.NumpyArray(close.reshape(-1)), 2)))
+    gen_counts = counts["GenPart"]
+    events["GenPart_pdgId"] = jagged(gen_counts, np.random.choice([24, -24, 12, 14, 16, 5, 21], gen_counts.sum()).astype(np.int32))
+    events["GenPart_status"] = jagged(gen_counts, np.random.choice([1, 22, 52], gen_counts.sum()).astype(np.int32))
+    events["GenPart_genPartIdxMother"] = jagged(gen_counts, np.concatenate(
+        [np.random.randint(-1, max(c, 1), c) for c in gen_counts]).astype(np.int32))
+    events["nGenPart"] = ak.Array(gen_counts.astype(np.int32))
+    events["genWeight"] = ak.Array(np.ones(nevents, dtype=np.float32))
+    events["Event_HT"] = ak.Array(np.random.uniform(0, 1000, nevents))
+    return events
+
+# ArrayBuilder versions as they were before the flat buffer port
+@numba.jit(nopython=True)
+def looseIdx(events, builder):
+    for event in events:
+        builder.begin_list()
+        for eidx in range(len(event.Electron_pt)):
+            builder.integer(eidx)
+        builder.end_list()
+
+@numba.jit(nopython=True)
+def closest_jet(builder, eta, phi, jet_eta, jet_phi):
+    for lidx in range(len(eta)):
+        mindr = 10
+        minidx = -1
+        for jidx in range(len(jet_eta)):
+            dr = deltaR(phi[lidx], eta[lidx], jet_phi[jidx], jet_eta[jidx])
+            if mindr > dr:
+                mindr = dr
+                minidx = jidx
+        builder.begin_list()
+        builder.integer(minidx)
+        builder.real(mindr)
+        builder.end_list()
+
+# Electron.closeJet and Muon.closeJet, one after the other
+@numba.jit(nopython=True)
+def closeJet(events, builder):
+    for event in events:
+        builder.begin_list()
+        closest_jet(builder, event.Electron_eta, event.Electron_phi,
+                    event.Jet_eta, event.Jet_phi)
+        closest_jet(builder, event.Muon_eta, event.Muon_phi,
+                    event.Jet_eta, event.Jet_phi)
+        builder.end_list()
+
+@numba.jit(nopython=True)
+def fullIso(events, builder):
+    I2 = 0.8
+    I3_pow2 = 7.2**2
+    for event in events:
+        builder.begin_list()
+        for eidx in range(len(event.Electron_eta)):
+            jidx = int(event.Electron_closeJetIndex[eidx][0])
+            pt = event.Electron_pt[eidx] / event.Electron_eCorr[eidx]
+            if jidx < 0 or pt/event.Jet_pt[jidx] > I2:
+                builder.boolean(True)
+                continue
+            jetrel = jetRel(pt, event.Electron_eta[eidx],
+                            event.Electron_phi[eidx], event.Jet_pt[jidx],
+                            event.Jet_eta[jidx], event.Jet_phi[jidx])
+            builder.boolean(jetrel > I3_pow2)
+        builder.end_list()
+
+@numba.jit(nopython=True)
+def jetCloseJet(events, builder):
+    for event in events:
+        builder.begin_list()
+        close_jet = []
+        for i in range(len(event.Electron_closeJetIndex)):
+            if event.Electron_closeJetIndex[i][1] < 0.16:
+                close_jet.append(int(event.Electron_closeJetIndex[i][0]))
+        for i in range(len(event.Muon_closeJetIndex)):
+            if event.Muon_closeJetIndex[i][1] < 0.16:
+                close_jet.append(int(event.Muon_closeJetIndex[i][0]))
+        for jidx in range(len(event.Jet_eta)):
+            isClose = jidx in close_jet
+            builder.boolean(not isClose)
+        builder.end_list()
+
+@numba.jit(nopython=True)
+def wdecay_scale(events, builder):
+    pdglepW = 0.3258
+    genlepW = 1.0/3
+    lep_ratio = pdglepW/genlepW
+    had_ratio = (1 - pdglepW)/(1 - genlepW)
+    for event in events:
+        nlepW = 0
+        nW = 0
+        for i in range(event.nGenPart):
+            if (abs(event.GenPart_pdgId[i]) == 24 and
+                (event.GenPart_status[i] == 22 or event.GenPart_status[i] == 52) and
+                abs(event.GenPart_pdgId[event.GenPart_genPartIdxMother[i]]) != 24):
+                nW += 1
+            elif((abs(event.GenPart_pdgId[i]) == 12
+                   or abs(event.GenPart_pdgId[i]) == 14
+                   or abs(event.GenPart_pdgId[i]) == 16)
+                 and abs(event.GenPart_pdgId[event.GenPart_genPartIdxMother[i]]) == 24):
+                 nlepW += 1
+        nhadW = nW - nlepW
+        builder.real(lep_ratio**nlepW * had_ratio**nhadW)
+
+@numba.jit(nopython=True)
+def set_channel(events, builder):
+    for event in events:
+        nLeps = len(event.Electron_charge) + len(event.Muon_charge)
+        if nLeps <= 1:
+            builder.integer(nLeps)
+        else:
+            q1, q2 = 0, 0
+            p1, p2 = 0, 0
+            chan = 10*nLeps
+            if len(event.Electron_pt) > 1:
+                p2, q2 = event.Electron_pt[1], event.Electron_charge[1]
+            if len(event.Electron_pt) > 0:
+                p1, q1 = event.Electron_pt[0], event.Electron_charge[0]
+            if len(event.Muon_pt) > 0:
+                if event.Muon_pt[0] > p1:
+                    p2, q2 = p1, q1
+                    p1, q1 = event.Muon_pt[0], event.Muon_charge[0]
+                    chan += 2
+                elif event.Muon_pt[0] > p2:
+                    p2, q2 = event.Muon_pt[0], event.Muon_charge[0]
+                    chan += 1
+            if len(event.Muon_pt) > 1:
+                if event.Muon_pt[1] > p2:
+                    p2, q2 = event.Muon_pt[1], event.Muon_charge[1]
+                    chan += 1
+            builder.integer(chan*q1*q2)
+
+@numba.jit(nopython=True)
+def calc_HT(events, builder):
+    for event in events:
+        HT = 0
+        for j in range(len(event["Jet_pt"])):
+            HT += event.Jet_pt[j]
+        builder.real(HT)
+
+@numba.jit(nopython=True)
+def calc_centrality(events, builder):
+    for event in events:
+        eTot = 0.0001
+        for j in range(len(event["Jet_pt"])):
+            p = event.Jet_pt[j]*math.cosh(event.Jet_eta[j])
+            eTot += math.sqrt(p**2 + event.Jet_mass[j])
+        builder.real(event.Event_HT/eTot)
+
+@numba.jit(nopython=True)
+def calc_sphericity(events, builder):
+    for event in events:
+        if len(event["Jet_pt"]) == 0:
+            builder.real(-1)
+            continue
+        sphere = np.zeros((3,3))
+        for i in range(len(event["Jet_pt"])):
+            p_vec = [event.Jet_pt[i]*math.cos(event.Jet_phi[i]),
+                     event.Jet_pt[i]*math.sin(event.Jet_phi[i]),
+                     event.Jet_pt[i]*math.sinh(event.Jet_eta[i])]
+            sphere += np.outer(p_vec, p_vec)
+        sphere = sphere/np.trace(sphere)
+        eig, _ = np.linalg.eig(sphere)
+        builder.real(3/2*(1-max(eig)))
+
+@numba.jit(nopython=True)
+def tight_lep_scale(events, builder):
+    for event in events:
+        scale = 1.
+        for i in range(len(event.Electron_scale)):
+            scale *= event.Electron_scale[i]
+            if event.Event_HT < 300:
+                scale *= event.Electron_scale[i]
+            else:
+                scale *= event.Electron_scale[i]
+        for i in range(len(event.Muon_scale)):
+            scale *= event.Muon_scale[i]*event.Muon_scale[i]
+        builder.real(scale)
+
+# name: (ArrayBuilder version, flat version, vals, addvals)
+kernels = {
+    "looseIdx": (looseIdx, Electron.looseIdx, ["Electron_pt"], []),
+    "Jet.leptonCloseJet": (closeJet, Jet.leptonCloseJet, Jet.lepton_close_jet, []),
+    "Electron.fullIso": (fullIso, Electron.fullIso, Electron.v_fullIso,
+                         ["Electron_closeJetIndex"]),
+    "Jet.closeJet": (jetCloseJet, Jet.closeJet, Jet.close_jet,
+                     ["Electron_closeJetIndex", "Muon_closeJetIndex"]),
+    "wdecay_scale": (wdecay_scale, EventWide.wdecay_scale, EventWide.gen_vars, []),
+    "set_channel": (set_channel, EventWide.set_channel, EventWide.lep_chans, []),
+    "calc_HT": (calc_HT, EventWide.calc_HT, EventWide.ht, []),
+    "calc_centrality": (calc_centrality, EventWide.calc_centrality,
+                        EventWide.centrality, ["Event_HT"]),
+    "calc_event_shape": (calc_sphericity, EventWide.calc_event_shape,
+                         EventWide.sphericity, []),
+    "tight_lep_scale": (tight_lep_scale, EventWide.tight_lep_scale, ["genWeight"],
+                        ["Electron_scale", "Electron_scale", "Electron_scale",
+                         "Muon_scale", "Muon_scale", "Event_HT"]),
+}
+
+def run_builder(kernel, events, vals, addvals):
+    array = ak.zip({col: events[col] for col in vals + addvals}, depth_limit=1)
+    builder = ak.ArrayBuilder()
+    kernel(array, builder)
+    return builder.snapshot()
+
+def run_flat(kernel, events, vals, addvals):
+    columns = [(col, col.split("_")[0], events[col]) for col in vals]
+    columns += [(col, col, events[col]) for col in addvals]
+    return Process.run_flat(kernel, columns, len(events["genWeight"]))
+
+def timeit(func, *args, repeat=5):
+    func(*args)  # compile
+    begin = time.perf_counter()
+    for _ in range(repeat):
+        func(*args)
+    return (time.perf_counter() - begin)/repeat
+
+if __name__ == "__main__":
+    events = make_events(100000)
+    print("{:>22} {:>14} {:>14} {:>8}".format("kernel", "builder (s)",
+                                              "flat (s)", "speedup"))
+    for name, (builder_kernel, flat_kernel, vals, addvals) in kernels.items():
+        t_builder = timeit(run_builder, builder_kernel, events, vals, addvals)
+        t_flat = timeit(run_flat, flat_kernel, events, vals, addvals)
+        print("{:>22} {:>14.4f} {:>14.4f} {:>8.1f}".format(name, t_builder, t_flat,
+                                                         t_builder/t_flat))
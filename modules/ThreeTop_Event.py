@@ -7,7 +7,11 @@ import numba
 import math
 
 from python.Process import Process
+from python.FlatKernel import flat_kernel
+from python.ScaleFactor import ScaleFactor
 from Utilities.FileGetter import pre
+from python.Common import shape_eigenvalues
+from python.PairEngine import PairEngine
 
 class EventWide(Process):
     def __init__(self, process):
@@ -16,13 +20,27 @@ class EventWide(Process):
         self.add_job("set_channel", outmask = "Event_channels",
                      inmask = ["Electron_finalMask", "Muon_finalMask"],
                      vals = EventWide.lep_chans)
+        self.add_job("pass_zveto", outmask = "Event_ZVeto",
+                     inmask = ["Electron_looseMask", "Muon_looseMask"],
+                     vals = EventWide.zveto,
+                     addvals = [("Electron_finalMask", "Electron_looseIndex"),
+                                ("Muon_finalMask", "Muon_looseIndex")])
         self.add_job("calc_HT", outmask = "Event_HT", inmask = "Jet_jetMask",
                      vals = EventWide.ht)
         self.add_job("calc_centrality", outmask = "Event_centrality",
                      inmask = "Jet_jetMask", vals = EventWide.centrality,
                      addvals = [(None, "Event_HT")])
-        self.add_job("calc_sphericity", outmask = "Event_sphericity",
+        self.add_job("calc_event_shape", outmask = "Event_shapeEigenvalues",
                      inmask = "Jet_jetMask", vals = EventWide.sphericity)
+        self.add_job("calc_sphericity", outmask = "Event_sphericity",
+                     vals = ["genWeight"],
+                     addvals = [(None, "Event_shapeEigenvalues")])
+        self.add_job("calc_aplanarity", outmask = "Event_aplanarity",
+                     vals = ["genWeight"],
+                     addvals = [(None, "Event_shapeEigenvalues")])
+        self.add_job("calc_planarity", outmask = "Event_planarity",
+                     vals = ["genWeight"],
+                     addvals = [(None, "Event_shapeEigenvalues")])
         self.add_job("save_var", outmask = "Event_MET",
                      vals = ["MET_pt"])
 
@@ -34,7 +52,8 @@ class EventWide(Process):
                      addvals = [(None, "Event_channels")])
         
         # Scale factors
-        self.add_job("pileup_scale", outmask = "Event_pileupScale",
+        self.add_job(ScaleFactor.get_name("pileup", self.year),
+                     outmask = "Event_pileupScale",
                      vals = ["Pileup_nTrueInt"])
         self.add_job("wdecay_scale", outmask = "Event_wDecayScale",
                      vals = EventWide.gen_vars)
@@ -72,83 +91,86 @@ class EventWide(Process):
         )
 
 
-    @staticmethod
-    @numba.vectorize('f8(f8)', nopython=True)
-    def pileup_scale(pileup):
-        pileupScales = [
-            0.366077, 0.893925, 1.197716, 0.962699, 1.120976, 1.164859, 0.795599, 0.495824,
-            0.742182, 0.878856, 0.964232, 1.072499, 1.125335, 1.176027, 1.202083, 1.207643,
-            1.200176, 1.182682, 1.143998, 1.096632, 1.065602, 1.051166, 1.051600, 1.050630,
-            1.049862, 1.058173, 1.072155, 1.083030, 1.095693, 1.107871, 1.094621, 1.082620,
-            1.041247, 0.985752, 0.910807, 0.820923, 0.716787, 0.610013, 0.503118, 0.404841,
-            0.309195, 0.227920, 0.163690, 0.113180, 0.077300, 0.050922, 0.031894, 0.020094,
-            0.012263, 0.007426, 0.004380, 0.002608, 0.001566, 0.000971, 0.000729, 0.000673,
-            0.000730, 0.000949, 0.001355, 0.001894, 0.003082, 0.004097, 0.004874, 0.005256,
-            0.005785, 0.005515, 0.005000, 0.004410, 0.004012, 0.003548, 0.003108, 0.002702,
-            0.002337, 0.002025, 0.001723, ]
-        if int(pileup) > len(pileupScales):
-            return 0.
-        else:
-            return pileupScales[int(pileup)]
-
-
     gen_vars = pre("GenPart", ["pdgId", "genPartIdxMother", "status"]) \
         + ["nGenPart"]
     @staticmethod
-    @numba.jit(nopython=True)
-    def wdecay_scale(events, builder):
+    @flat_kernel(np.float64)
+    def wdecay_scale(pdgId, mother, status, nGenPart, offsets, out):
         pdglepW = 0.3258
         genlepW = 1.0/3
         lep_ratio = pdglepW/genlepW
         had_ratio = (1 - pdglepW)/(1 - genlepW)
 
-        for event in events:
+        for ev in range(len(offsets) - 1):
             nlepW = 0
             nW = 0
-            for i in range(event.nGenPart):
-                if (abs(event.GenPart_pdgId[i]) == 24 and
-                    (event.GenPart_status[i] == 22 or event.GenPart_status[i] == 52) and
-                    abs(event.GenPart_pdgId[event.GenPart_genPartIdxMother[i]]) != 24):
+            for i in range(offsets[ev], offsets[ev+1]):
+                # genPartIdxMother of -1 wraps around like a python index
+                mom = mother[i] + (offsets[ev] if mother[i] >= 0 else offsets[ev+1])
+                if (abs(pdgId[i]) == 24 and
+                    (status[i] == 22 or status[i] == 52) and
+                    abs(pdgId[mom]) != 24):
 
                     nW += 1
-                elif((abs(event.GenPart_pdgId[i]) == 12
-                       or abs(event.GenPart_pdgId[i]) == 14
-                       or abs(event.GenPart_pdgId[i]) == 16)
-                     and abs(event.GenPart_pdgId[event.GenPart_genPartIdxMother[i]]) == 24):
+                elif((abs(pdgId[i]) == 12
+                       or abs(pdgId[i]) == 14
+                       or abs(pdgId[i]) == 16)
+                     and abs(pdgId[mom]) == 24):
                      nlepW += 1
 
             nhadW = nW - nlepW
-            builder.real(lep_ratio**nlepW * had_ratio**nhadW)
+            out[ev] = lep_ratio**nlepW * had_ratio**nhadW
+
+    # Events with an opposite sign pair of a tight and a loose lepton of the
+    # pair types in the low mass or Z window fail the veto
+    zveto = pre("Electron", ["pt", "eCorr", "eta", "phi", "charge"]) + \
+        pre("Muon", ["pt", "eta", "phi", "charge"])
+    zveto_pairs = [("Electron", "Electron"), ("Muon", "Muon")]
+    zveto_windows = [(-np.inf, 12**2), ((91.188 - 15)**2, (91.188 + 15)**2)]
+    @staticmethod
+    def pass_zveto(events):
+        pairs = PairEngine()
+        pairs.add_collection("Electron",
+                             events["Electron_pt"]/events["Electron_eCorr"],
+                             events["Electron_eta"], events["Electron_phi"],
+                             events["Electron_charge"], events["Electron_looseIndex"])
+        pairs.add_collection("Muon", events["Muon_pt"], events["Muon_eta"],
+                             events["Muon_phi"], events["Muon_charge"],
+                             events["Muon_looseIndex"])
+        return ak.Array(~pairs.any_in_windows(EventWide.zveto_pairs,
+                                              EventWide.zveto_windows))
 
     lep_chans = ["Electron_charge", "Electron_pt", "Muon_charge", "Muon_pt"]
     @staticmethod
-    @numba.jit(nopython=True)
-    def set_channel(events, builder):
-        for event in events:
-            nLeps = len(event.Electron_charge) + len(event.Muon_charge)
+    @flat_kernel(np.int64)
+    def set_channel(e_charge, e_pt, m_charge, m_pt, e_offsets, m_offsets, out):
+        for ev in range(len(e_offsets) - 1):
+            e0, nElec = e_offsets[ev], e_offsets[ev+1] - e_offsets[ev]
+            m0, nMuon = m_offsets[ev], m_offsets[ev+1] - m_offsets[ev]
+            nLeps = nElec + nMuon
             if nLeps <= 1:
-                builder.integer(nLeps)
+                out[ev] = nLeps
             else:
                 q1, q2 = 0, 0
-                p1, p2 = 0, 0
+                p1, p2 = 0., 0.
                 chan = 10*nLeps
-                if len(event.Electron_pt) > 1:
-                    p2, q2 = event.Electron_pt[1], event.Electron_charge[1]
-                if len(event.Electron_pt) > 0:
-                    p1, q1 = event.Electron_pt[0], event.Electron_charge[0]
-                if len(event.Muon_pt) > 0:
-                    if event.Muon_pt[0] > p1:
+                if nElec > 1:
+                    p2, q2 = e_pt[e0+1], e_charge[e0+1]
+                if nElec > 0:
+                    p1, q1 = e_pt[e0], e_charge[e0]
+                if nMuon > 0:
+                    if m_pt[m0] > p1:
                         p2, q2 = p1, q1
-                        p1, q1 = event.Muon_pt[0], event.Muon_charge[0]
+                        p1, q1 = m_pt[m0], m_charge[m0]
                         chan += 2
-                    elif event.Muon_pt[0] > p2:
-                        p2, q2 = event.Muon_pt[0], event.Muon_charge[0]
+                    elif m_pt[m0] > p2:
+                        p2, q2 = m_pt[m0], m_charge[m0]
                         chan += 1
-                if len(event.Muon_pt) > 1:
-                    if event.Muon_pt[1] > p2:
-                        p2, q2 = event.Muon_pt[1], event.Muon_charge[1]
+                if nMuon > 1:
+                    if m_pt[m0+1] > p2:
+                        p2, q2 = m_pt[m0+1], m_charge[m0+1]
                         chan += 1
-                builder.integer(chan*q1*q2)
+                out[ev] = chan*q1*q2
 
     triggers = pre("HLT", ["DoubleMu8_Mass8_PFHT300",
                            "Mu8_Ele8_CaloIdM_TrackIdM_Mass8_PFHT300",
@@ -167,42 +189,54 @@ class EventWide(Process):
     
     ht = ["Jet_pt"]
     @staticmethod
-    @numba.jit(nopython=True)
-    def calc_HT(events, builder):
-        for event in events:
+    @flat_kernel(np.float64)
+    def calc_HT(pt, offsets, out):
+        for ev in range(len(offsets) - 1):
             HT = 0
-            for j in range(len(event["Jet_pt"])):
-                HT += event.Jet_pt[j]
-            builder.real(HT)
+            for j in range(offsets[ev], offsets[ev+1]):
+                HT += pt[j]
+            out[ev] = HT
             
     centrality = ["Jet_pt", "Jet_eta", "Jet_mass"]
     @staticmethod
-    @numba.jit(nopython=True)
-    def calc_centrality(events, builder):
-        for event in events:
+    @flat_kernel(np.float64)
+    def calc_centrality(pt, eta, mass, HT, offsets, out):
+        for ev in range(len(offsets) - 1):
             eTot = 0.0001 # for 0jet case
-            for j in range(len(event["Jet_pt"])):
-                p = event.Jet_pt[j]*math.cosh(event.Jet_eta[j])
-                eTot += math.sqrt(p**2 + event.Jet_mass[j])
-            builder.real(event.Event_HT/eTot)
+            for j in range(offsets[ev], offsets[ev+1]):
+                p = pt[j]*math.cosh(eta[j])
+                eTot += math.sqrt(p**2 + mass[j])
+            out[ev] = HT[ev]/eTot
 
     sphericity = ["Jet_pt", "Jet_eta", "Jet_phi"]
     @staticmethod
-    @numba.jit(nopython=True)
-    def calc_sphericity(events, builder):
-        for event in events:
-            if len(event["Jet_pt"]) == 0:
-                builder.real(-1)
-                continue
-            sphere = np.zeros((3,3))
-            for i in range(len(event["Jet_pt"])):
-                p_vec = [event.Jet_pt[i]*math.cos(event.Jet_phi[i]),
-                         event.Jet_pt[i]*math.sin(event.Jet_phi[i]),
-                         event.Jet_pt[i]*math.sinh(event.Jet_eta[i])]
-                sphere += np.outer(p_vec, p_vec)
-            sphere = sphere/np.trace(sphere)
-            eig, _ = np.linalg.eig(sphere)
-            builder.real(3/2*(1-max(eig)))
+    @flat_kernel(np.float64, width=(3, 3), finish=shape_eigenvalues)
+    def calc_event_shape(pt, eta, phi, offsets, out):
+        for ev in range(len(offsets) - 1):
+            for i in range(offsets[ev], offsets[ev+1]):
+                p_vec = (pt[i]*math.cos(phi[i]), pt[i]*math.sin(phi[i]),
+                         pt[i]*math.sinh(eta[i]))
+                for a in range(3):
+                    for b in range(3):
+                        out[ev, a, b] += p_vec[a]*p_vec[b]
+
+    @staticmethod
+    @flat_kernel(np.float64)
+    def calc_sphericity(dummy, eig, out):
+        for ev in range(len(out)):
+            out[ev] = -1 if eig[ev, 0] < 0 else 3/2*(1 - eig[ev, 0])
+
+    @staticmethod
+    @flat_kernel(np.float64)
+    def calc_aplanarity(dummy, eig, out):
+        for ev in range(len(out)):
+            out[ev] = -1 if eig[ev, 0] < 0 else 3/2*eig[ev, 2]
+
+    @staticmethod
+    @flat_kernel(np.float64)
+    def calc_planarity(dummy, eig, out):
+        for ev in range(len(out)):
+            out[ev] = -1 if eig[ev, 0] < 0 else eig[ev, 1] - eig[ev, 2]
 
     @staticmethod
     @numba.vectorize("f4(f4)")
@@ -229,16 +263,17 @@ class EventWide(Process):
         return 1
             
     @staticmethod
-    @numba.jit(nopython=True)
-    def tight_lep_scale(events, builder):
-        for event in events:
+    @flat_kernel(np.float64)
+    def tight_lep_scale(genWeight, GSFScale, lowHTScale, highHTScale, muonScale,
+                        trackingScale, HT, e_offsets, m_offsets, out):
+        for ev in range(len(e_offsets) - 1):
             scale = 1.
-            for i in range(len(event.Electron_GSFScale)):
-                scale *= event.Electron_GSFScale[i]
-                if event.Event_HT < 300:
-                    scale *= event.Electron_lowHTScale[i]
+            for i in range(e_offsets[ev], e_offsets[ev+1]):
+                scale *= GSFScale[i]
+                if HT[ev] < 300:
+                    scale *= lowHTScale[i]
                 else:
-                    scale *= event.Electron_highHTScale[i]
-            for i in range(len(event.Muon_scale)):
-                scale *= event.Muon_scale[i]*event.Muon_trackingScale[i]
-            builder.real(scale)
+                    scale *= highHTScale[i]
+            for i in range(m_offsets[ev], m_offsets[ev+1]):
+                scale *= muonScale[i]*trackingScale[i]
+            out[ev] = scale
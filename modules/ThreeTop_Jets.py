@@ -6,12 +6,17 @@ import numpy as np
 import numba
 
 from python.Process import Process
+from python.FlatKernel import flat_kernel
 from Utilities.FileGetter import pre
+from python.Common import deltaR
 
 class Jet(Process):
     def __init__(self, process):
         super().__init__(process)
 
+        self.add_job("leptonCloseJet", outmask="Jet_leptonCloseJet",
+                     inmask=["Electron_basicFakeMask", "Muon_basicFakeMask"],
+                     vals = Jet.lepton_close_jet)
         self.add_job("closeJet", outmask="Jet_rmCloseJet", vals = Jet.close_jet,
                      addvals = [("Electron_fakeMask","Electron_closeJetIndex"),
                                 ("Muon_fakeMask", "Muon_closeJetIndex")])
@@ -21,26 +26,49 @@ class Jet(Process):
                      inmask="Jet_rmCloseJet", vals = Jet.bjet)
 
     # Numba methods
-    close_jet = ["Muon_eta", "Muon_phi", "Jet_eta", "Jet_phi",
-                 "Electron_eta", "Electron_phi"]
+    # One pass over the jets of each event gives every electron, then every
+    # muon, the local index of and deltaR (squared) to its closest jet, -1
+    # and 10 without jets. Electron and Muon_closeJetIndex are cut from it
+    lepton_close_jet = pre("Electron", ["eta", "phi"]) + pre("Muon", ["eta", "phi"]) + \
+        pre("Jet", ["eta", "phi"])
     @staticmethod
-    @numba.jit(nopython=True)
-    def closeJet(events, builder):
-        j = 0
-        for event in events:
-            builder.begin_list()
-            close_jet = []
-            for i in range(len(event.Electron_closeJetIndex)):
-                if event.Electron_closeJetIndex[i][1] < 0.16:
-                    close_jet.append(int(event.Electron_closeJetIndex[i][0]))
-            for i in range(len(event.Muon_closeJetIndex)):
-                if event.Muon_closeJetIndex[i][1] < 0.16:
-                    close_jet.append(int(event.Muon_closeJetIndex[i][0]))
-            for jidx in range(len(event.Jet_eta)):
-                isClose = jidx in close_jet
-                builder.boolean(not isClose)
-            builder.end_list()
-            j+=1
+    @flat_kernel(np.float64, like=("Electron_eta", "Muon_eta"), width=2)
+    def leptonCloseJet(elec_eta, elec_phi, muon_eta, muon_phi, jet_eta, jet_phi,
+                       elec_offsets, muon_offsets, offsets, out):
+        for ev in range(len(offsets) - 1):
+            first = elec_offsets[ev] + muon_offsets[ev]
+            nelec = elec_offsets[ev+1] - elec_offsets[ev]
+            nlep = nelec + muon_offsets[ev+1] - muon_offsets[ev]
+            out[first:first+nlep, 0] = -1
+            out[first:first+nlep, 1] = 10
+            for jidx in range(offsets[ev], offsets[ev+1]):
+                for lidx in range(nlep):
+                    if lidx < nelec:
+                        eta = elec_eta[elec_offsets[ev] + lidx]
+                        phi = elec_phi[elec_offsets[ev] + lidx]
+                    else:
+                        eta = muon_eta[muon_offsets[ev] + lidx - nelec]
+                        phi = muon_phi[muon_offsets[ev] + lidx - nelec]
+                    dr = deltaR(phi, eta, jet_phi[jidx], jet_eta[jidx])
+                    if out[first + lidx, 1] > dr:
+                        out[first + lidx, 0] = jidx - offsets[ev]
+                        out[first + lidx, 1] = dr
+
+    # Only the closest jet of each fake lepton is needed, not the leptons.
+    # The fake masks need the closest jet, so this is a pass of its own
+    close_jet = ["Jet_eta"]
+    @staticmethod
+    @flat_kernel(np.bool_, like="Jet_eta")
+    def closeJet(eta, elec_close, muon_close, offsets, elec_close_offsets,
+                 muon_close_offsets, out):
+        out[:] = True
+        for ev in range(len(offsets) - 1):
+            for i in range(elec_close_offsets[ev], elec_close_offsets[ev+1]):
+                if elec_close[i, 1] < 0.16:
+                    out[offsets[ev] + int(elec_close[i, 0])] = False
+            for i in range(muon_close_offsets[ev], muon_close_offsets[ev+1]):
+                if muon_close[i, 1] < 0.16:
+                    out[offsets[ev] + int(muon_close[i, 0])] = False
 
 
     jet = pre("Jet", ["pt", "eta", "jetId"])
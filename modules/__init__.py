@@ -1,3 +1,6 @@
+import os
+import glob
+
 from .ThreeTop_Muon import Muon
 from .ThreeTop_Jets import Jet
 from .ThreeTop_Electron import Electron
@@ -5,12 +8,16 @@ from .ThreeTop_Event import EventWide
 
 from python.Scheduler import Scheduler
 from python.CutApplier import CutApplier
+from python.ScaleFactor import ScaleFactor
 from Utilities.FileGetter import pre
 
-# Run Specifics
-Scheduler.add_step([Muon, Electron])
-Scheduler.add_step([Jet])
-Scheduler.add_step([EventWide])
+# Run Specifics (job order comes from the inmask/addvals of each job)
+Scheduler.add_step([Muon, Electron, Jet, EventWide])
+
+# Binned scale factor tables of every year, jobs use them by name
+for filename in sorted(glob.glob(os.path.join(os.path.dirname(__file__), "..", "data",
+                                              "scale_factors_*.json"))):
+    ScaleFactor.add_file(filename)
 
 channels = ['had', 'one', 'SS', 'OS', 'multi']
 
@@ -30,29 +37,43 @@ CutApplier.add_vars("BJets", pre("Jet", ["pt", "eta", "phi", "mass"]), "Jet_bjet
 CutApplier.add_vars("Event_MET", ["MET_pt", "MET_phi"])
 
 CutApplier.add_vars_derived(
-    "Event_variables", pre("Event", ["HT", "channels", "centrality", "sphericity"]))
+    "Event_variables", pre("Event", ["HT", "channels", "centrality", "sphericity",
+                                      "aplanarity"]))
 
-# General Cuts
-CutApplier.add_cut("Event_MetFilterMask")
-CutApplier.add_cut("Event_MET > 25")
+# Histograms filled during apply, expressions use the groups above
+CutApplier.add_hist("HT", "Event_variables.Event_HT", (30, 0, 1500))
+CutApplier.add_hist("MET", "Event_MET.MET_pt", (25, 0, 500))
+CutApplier.add_hist("NJets", "ak.num(Jets.Jet_pt)", (15, 0, 15))
+CutApplier.add_hist("NBJets", "ak.num(BJets.Jet_pt)", (8, 0, 8))
+CutApplier.add_hist("JetPt", "Jets.Jet_pt", (40, 0, 800))
+CutApplier.add_hist("HT_NJets", "Event_variables.Event_HT", (30, 0, 1500),
+                    "ak.num(Jets.Jet_pt)", (15, 0, 15))
+
+# General Cuts (skim cuts go cheapest first, they are used by --preskim)
+CutApplier.add_cut("Event_MetFilterMask", skim=True)
+CutApplier.add_cut("Event_MET > 25", skim=True)
 # CutApplier.add_cut("Event_triggerMask")
-CutApplier.add_cut("Event_HT > 300")
+CutApplier.add_cut("Event_HT > 300", skim=True)
 CutApplier.add_cut("ak.count_nonzero(Jet_jetMask, axis=1) >= 2")
 CutApplier.add_cut("ak.count_nonzero(Jet_bjetMask, axis=1) >= 1")
 
-def set_channel(chan):
+def get_channel_cuts(chan):
     if chan == "had":
-        CutApplier.add_cut("abs(Event_channels) == 0")
+        return ["abs(Event_channels) == 0"]
     elif chan == "one":
-        CutApplier.add_cut("abs(Event_channels) == 1")
+        return ["abs(Event_channels) == 1"]
+    elif chan == "SS":
+        return ["Event_ZVeto", "Event_channels > 1", "abs(Event_channels) < 30"]
+    elif chan == "OS":
+        return ["Event_ZVeto", "Event_channels < -1", "abs(Event_channels) < 30"]
     else:
-        CutApplier.add_cut("Muon_ZVeto")
-        CutApplier.add_cut("Electron_ZVeto")
-        if chan == "SS":
-            CutApplier.add_cut("Event_channels > 1")
-            CutApplier.add_cut("abs(Event_channels) < 30")
-        elif chan == "OS":
-            CutApplier.add_cut("Event_channels < -1")
-            CutApplier.add_cut("abs(Event_channels) < 30")
-        else:
-            CutApplier.add_cut("abs(Event_channels) >= 30")
+        return ["Event_ZVeto", "abs(Event_channels) >= 30"]
+
+def set_channel(chan):
+    for cut in get_channel_cuts(chan):
+        CutApplier.add_cut(cut)
+
+def set_channels(chans):
+    # All channels from one read, written to one file each
+    for chan in chans:
+        CutApplier.add_channel(chan, get_channel_cuts(chan))
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+import awkward1 as ak
+from bisect import bisect_right
+
+# A piece can also be a function giving the array, for pieces kept in a
+# smaller form (packed masks) until they are read.
+class ChunkBuffer:
+    def __init__(self, array=None):
+        self.pieces = list()
+        self.offsets = [0]
+        if array is not None:
+            self.append(array)
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def append(self, array):
+        self.pieces.append(array)
+        self.offsets.append(self.offsets[-1] + len(array))
+
+    def set_last(self, piece):
+        self.pieces[-1] = piece
+
+    def get_piece(self, idx):
+        piece = self.pieces[idx]
+        return piece() if callable(piece) else piece
+
+    def __getitem__(self, where):
+        if not isinstance(where, slice) or where.step not in (None, 1):
+            return self.snapshot()[where]
+        start, stop, _ = where.indices(len(self))
+        if start < self.offsets[0]:
+            raise IndexError("ChunkBuffer: entries before {} were cleared"
+                             .format(self.offsets[0]))
+
+        parts = list()
+        idx = bisect_right(self.offsets, start) - 1
+        while idx < len(self.pieces) and self.offsets[idx] < stop:
+            lo = max(start, self.offsets[idx]) - self.offsets[idx]
+            hi = min(stop, self.offsets[idx+1]) - self.offsets[idx]
+            piece = self.get_piece(idx)
+            parts.append(piece if hi - lo == len(piece) else piece[lo:hi])
+            idx += 1
+
+        if len(parts) == 1:
+            return parts[0]
+        elif len(parts) == 0:
+            return ak.Array([])
+        return ak.concatenate(parts)
+
+    def clear(self):
+        # Drop the stored pieces but keep counting entries from here on
+        self.pieces = list()
+        self.offsets = [self.offsets[-1]]
+
+    def snapshot(self):
+        if len(self.pieces) == 0:
+            return ak.Array([])
+        elif any(callable(piece) for piece in self.pieces):
+            # Stays packed, only the caller gets the whole array
+            pieces = [self.get_piece(idx) for idx in range(len(self.pieces))]
+            return pieces[0] if len(pieces) == 1 else ak.concatenate(pieces)
+        elif len(self.pieces) > 1:
+            # Concatenate once and keep the result so later calls are free
+            self.pieces = [ak.concatenate(self.pieces)]
+            self.offsets = [self.offsets[0], self.offsets[-1]]
+        return self.pieces[0]
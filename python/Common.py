@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import numba
 import math
+import numpy as np
 
 @numba.jit(nopython=True)
 def deltaR(lphi, leta, jphi, jeta):
@@ -16,11 +17,12 @@ def jetRel(lpt, leta, lphi, jpt, jeta, jphi):
     p_dot = jpt*lpt*(math.cosh(jeta - leta) - math.cos(jphi - lphi))
     return (p_dot*(2*p_jet*p_lep - p_dot)) / ((p_jet - p_lep)**2 + 2*p_dot)
 
-@numba.jit(nopython=True)
-def in_zmass(lpt, leta, lphi, Lpt, Leta, Lphi):
-    delta = 15
-    zMass = 91.188
-    up = zMass + delta
-    down = zMass - delta
-    mass = 2*lpt*Lpt*(math.cosh(leta-Leta) - math.cos(lphi-Lphi))
-    return mass < 12**2 or (mass > down**2 and mass < up**2)
+def shape_eigenvalues(tensor):
+    # Eigenvalues of each tensor normalized to unit trace, largest first,
+    # all -1 for events without jets
+    trace = np.trace(tensor, axis1=1, axis2=2)
+    empty = trace == 0
+    trace[empty] = 1
+    eig = np.linalg.eigvalsh(tensor / trace[:, None, None])[:, ::-1]
+    eig[empty] = -1
+    return eig
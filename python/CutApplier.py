@@ -1,43 +1,138 @@
 #!/usr/bin/env python3
 
-import uproot4 as uproot
 import awkward1 as ak
 import numpy as np
 import numba
+import re
+import time
+import copy
+from collections import OrderedDict
+from python.ChunkBuffer import ChunkBuffer
+from python.Histogram import Histogram
+from python.Process import Process
+from python.EventReader import EventReader
 
 class CutApplier:
     sf_list = list()
     cut_list = list()
+    skim_list = list()
     var_list = list()
     der_var_list = list()
-    def __init__(self, arrays, xsec):
-        self.arrays = arrays
-        self.cuts = np.ones(len(arrays), dtype=bool)
+    channel_list = list()
+    hist_list = list()
+    reorder = False
+    reorder_sample = 10000
+    compiled = dict()
+    config_list = ["sf_list", "cut_list", "skim_list", "var_list", "der_var_list",
+                   "channel_list", "hist_list", "reorder"]
+    def __init__(self, masks, xsec, nevents=None):
+        # Masks come from a MaskReader and are cut one chunk at a time
+        self.masks = masks
         self.all_vars = set()
-        scale = xsec/len(self.arrays)
-        print(xsec, len(self.arrays))
-        cuts = list()
-        for cut_name in CutApplier.cut_list:
-            for rep in ["Event", "Jet", "Electron", "Muon"]:
-                cut_name = cut_name.replace(rep, "arrays."+rep)
-            cuts.append(eval("ak.to_numpy({})".format(cut_name)))
-        self.cuts = np.all(cuts, axis=0)
-        
-        self.output = dict()
-        self.output = {"scale_factor": ak.Array([scale]*len(arrays[self.cuts]))}
-        for scale_name in CutApplier.sf_list:
-            print(scale_name, ak.sum(arrays[scale_name][self.cuts]))
-            self.output["scale_factor"] = (self.output["scale_factor"]
-                                           * arrays[scale_name][self.cuts])
+        if nevents is None:
+            nevents = masks.num_entries
+        self.scale = xsec/nevents
+        print(xsec, nevents)
+        self.cut_order = dict()
+        self.cutflow = OrderedDict()
+        self.sf_sums = {scale_name: 0. for scale_name in CutApplier.sf_list}
+        self.entries = {channel: list() for channel in CutApplier.get_channels()}
+
+        keys = ["scale_factor"]
         for group, add_vars, _ in CutApplier.var_list:
-            for var in add_vars:
-                self.output["{}/{}".format(group, var)] = ak.Array([])
+            keys += ["{}/{}".format(group, var) for var in add_vars]
             self.all_vars |= set(add_vars)
-            
         for group, add_vars in CutApplier.der_var_list:
-            for var in add_vars:
-                self.output["{}/{}".format(group, var)] = self.arrays[var][self.cuts]
-        print(ak.sum(self.output["scale_factor"]))
+            keys += ["{}/{}".format(group, var) for var in add_vars]
+        self.output = {channel: {key: ChunkBuffer() for key in keys}
+                       for channel in CutApplier.get_channels()}
+        self.hists = {channel: [Histogram(*hist) for hist in CutApplier.hist_list]
+                      for channel in CutApplier.get_channels()}
+
+    def set_arrays(self, arrays):
+        self.arrays = arrays
+        self.fields = set(ak.fields(arrays))
+        self.scale_factor = ak.Array([self.scale]*len(arrays))
+        for scale_name in CutApplier.sf_list:
+            self.scale_factor = self.scale_factor * arrays[scale_name]
+        self.weights = ak.to_numpy(self.scale_factor)
+
+        # Each cut only sees the events passing the ones before it. Channels
+        # go on from the events passing the shared cuts
+        shared_flow = [("all", len(arrays), float(np.sum(self.weights)))]
+        passed = self.run_cuts(None, CutApplier.cut_list, np.arange(len(arrays)),
+                               shared_flow)
+        self.cuts = self.get_mask(passed)
+        for scale_name in CutApplier.sf_list:
+            self.sf_sums[scale_name] += ak.sum(arrays[scale_name][self.cuts])
+
+        self.channels = OrderedDict()
+        if len(CutApplier.channel_list) == 0:
+            self.channels[None] = self.cuts
+            self.add_cutflow(None, shared_flow)
+        for channel, cut_list in CutApplier.channel_list:
+            cutflow = list(shared_flow)
+            channel_passed = self.run_cuts(channel, cut_list, passed, cutflow)
+            self.channels[channel] = self.get_mask(channel_passed)
+            self.add_cutflow(channel, cutflow)
+
+    def add_cutflow(self, channel, cutflow):
+        if channel not in self.cutflow:
+            self.cutflow[channel] = cutflow
+            return
+        self.cutflow[channel] = [(cut_name, count + chunk_count, weighted + chunk_weighted)
+                                 for (cut_name, count, weighted), (_, chunk_count, chunk_weighted)
+                                 in zip(self.cutflow[channel], cutflow)]
+
+    def print_cutflow(self):
+        for scale_name, total in self.sf_sums.items():
+            print(scale_name, total)
+        for channel, cutflow in self.cutflow.items():
+            print("Cutflow" if channel is None else "Cutflow {}".format(channel))
+            for cut_name, count, weighted in cutflow:
+                print("{:>50} {:>10} {:>14.4f}".format(cut_name, count, weighted))
+
+    @staticmethod
+    def compile_cut(cut_name):
+        if cut_name not in CutApplier.compiled:
+            CutApplier.compiled[cut_name] = compile(cut_name, cut_name, "eval")
+        return CutApplier.compiled[cut_name]
+
+    def eval_cut(self, cut_name, passed):
+        columns = {name: self.arrays[name][passed]
+                   for name in set(re.findall(r"\w+", cut_name)) & self.fields}
+        columns.update({"ak": ak, "np": np})
+        result = eval(CutApplier.compile_cut(cut_name), columns)
+        return ak.to_numpy(ak.fill_none(result, False))
+
+    def run_cuts(self, channel, cut_list, passed, cutflow):
+        # The order is found on the first chunk and kept for the rest
+        if CutApplier.reorder:
+            if channel not in self.cut_order:
+                self.cut_order[channel] = self.order_cuts(cut_list, passed)
+            cut_list = self.cut_order[channel]
+        for cut_name in cut_list:
+            if len(passed) > 0:
+                passed = passed[self.eval_cut(cut_name, passed)]
+            cutflow.append((cut_name, len(passed), float(np.sum(self.weights[passed]))))
+        return passed
+
+    def order_cuts(self, cut_list, passed):
+        # Cheapest per rejected event first, measured on the first events
+        sample = passed[:CutApplier.reorder_sample]
+        ranks = list()
+        for cut_name in cut_list:
+            begin = time.perf_counter()
+            rejected = 1 - np.mean(self.eval_cut(cut_name, sample)) if len(sample) else 0
+            cost = time.perf_counter() - begin
+            ranks.append(cost/rejected if rejected > 0 else np.inf)
+        order = sorted(range(len(cut_list)), key=lambda idx: ranks[idx])
+        return [cut_list[idx] for idx in order]
+
+    def get_mask(self, passed):
+        mask = np.zeros(len(self.arrays), dtype=bool)
+        mask[passed] = True
+        return mask
 
         
     @staticmethod
@@ -45,8 +140,28 @@ class CutApplier:
         CutApplier.sf_list.append(scale_name)
 
     @staticmethod
-    def add_cut(cut_name):
+    def add_cut(cut_name, skim=False):
         CutApplier.cut_list.append(cut_name)
+        if skim:
+            CutApplier.skim_list.append(cut_name)
+
+    @staticmethod
+    def set_reorder(reorder=True):
+        CutApplier.reorder = reorder
+
+    @staticmethod
+    def add_hist(name, expr, bins, expr_y=None, bins_y=None):
+        CutApplier.hist_list.append((name, expr, bins, expr_y, bins_y))
+
+    @staticmethod
+    def add_channel(channel, cut_list):
+        CutApplier.channel_list.append((channel, cut_list))
+
+    @staticmethod
+    def get_channels():
+        if len(CutApplier.channel_list) == 0:
+            return [None]
+        return [channel for channel, _ in CutApplier.channel_list]
 
     @staticmethod
     def add_vars(groupName, var_list, mask=None):
@@ -56,35 +171,137 @@ class CutApplier:
     def add_vars_derived(groupName, var_list):
         CutApplier.der_var_list.append((groupName, var_list))
 
-    def run(self, filename):
+    @staticmethod
+    def get_required():
+        required = set(CutApplier.sf_list)
+        cut_list = list(CutApplier.cut_list)
+        for _, channel_cuts in CutApplier.channel_list:
+            cut_list += channel_cuts
+        for cut_name in cut_list:
+            required |= set(re.findall(r"\w+", cut_name))
+        for _, _, mask_name in CutApplier.var_list:
+            if mask_name is not None:
+                required.add(mask_name)
+        for _, add_vars in CutApplier.der_var_list:
+            required |= set(add_vars)
+        return required
+
+    def run(self, filename, entry_start=None, entry_stop=None):
+        for outputs in self.iterate(filename, entry_start, entry_stop):
+            for channel, output in outputs.items():
+                for key, arr in output.items():
+                    self.output[channel][key].append(arr)
+
+    def iterate(self, filename, entry_start=None, entry_stop=None):
         allvars = list(self.all_vars)
-        if len(allvars) == 0:
+        start = 0 if entry_start is None else entry_start
+        if len(allvars) == 0 or EventReader.is_single(filename):
+            # The next chunks are cut and read ahead while this one is output
+            for chunk, array in EventReader.read_ahead(
+                    self.iterate_selected(filename, allvars, start)):
+                outputs = chunk.get_output(array)
+                self.fill_hists(outputs)
+                yield outputs
+            self.print_cutflow()
             return
-        start, end = 0, 0
-        for array in uproot.iterate("{}:Events".format(filename), allvars):
-            end += len(array)
-            mask = self.cuts[start:end]
-            print("Events Considered: {}".format(end))
-            for group, add_vars, mask_name in CutApplier.var_list:
-                if mask_name is not None:
-                    submask = self.arrays[mask_name][start:end]
-                    subarray = array[add_vars][submask]
-                    subarray = subarray[mask]
+        for array in EventReader.iterate(filename, allvars, entry_start, entry_stop):
+            self.set_arrays(self.masks.read(len(array)))
+            selected = self.add_entries(start)
+            start += len(array)
+            print("Events Considered: {}".format(start))
+            outputs = self.get_output(array[selected])
+            self.fill_hists(outputs)
+            yield outputs
+        self.print_cutflow()
+
+    def iterate_selected(self, filename, allvars, start):
+        # Cut first, then read only the clusters holding passing events.
+        # Masks go in chunks of the events iterate would read. Each chunk is
+        # cut on a shallow copy, it shares the totals but keeps its own cuts
+        tree, step = None, None
+        if len(allvars) > 0:
+            tree = EventReader.get_tree(filename)
+            step = EventReader.get_entry_step(tree, allvars)
+        for arrays in self.masks.iterate(step):
+            chunk = copy.copy(self)
+            chunk.set_arrays(arrays)
+            selected = chunk.add_entries(start)
+            array = None
+            if tree is not None:
+                array = EventReader.read_entries(tree, allvars, start + selected, step)
+            start += len(arrays)
+            print("Events Considered: {}, Selected: {}".format(start, len(selected)))
+            yield chunk, array
+
+    def add_entries(self, start):
+        # Entries in any channel, local to the chunk. Each channel keeps its
+        # entry numbers in the event file
+        for channel, mask in self.channels.items():
+            self.entries[channel].append(start + np.nonzero(mask)[0])
+        self.union = np.any(list(self.channels.values()), axis=0)
+        return np.nonzero(self.union)[0]
+
+    def fill_hists(self, outputs):
+        for channel, output in outputs.items():
+            for hist in self.hists[channel]:
+                values = [self.eval_expr(expr, output) for expr in hist.exprs]
+                hist.fill(values, output["scale_factor"])
+
+    def eval_expr(self, expr, output):
+        # Groups of the output are records, e.g. Jets.Jet_pt
+        names = set(re.findall(r"\w+", expr))
+        columns = dict()
+        for key, arr in output.items():
+            group, _, var = key.partition("/")
+            if group not in names:
+                continue
+            elif var == "":
+                columns[group] = arr
+            else:
+                columns.setdefault(group, dict())[var] = arr
+        columns = {group: ak.zip(arr, depth_limit=1) if isinstance(arr, dict) else arr
+                   for group, arr in columns.items()}
+        columns.update({"ak": ak, "np": np})
+        return eval(CutApplier.compile_cut(expr), columns)
+
+    def get_output(self, array):
+        # array only has the events in any channel. Build the output once,
+        # then split it
+        output = self.get_selected(array, self.union)
+        if len(self.channels) == 1:
+            return {channel: output for channel in self.channels}
+        return {channel: {key: arr[mask[self.union]] for key, arr in output.items()}
+                for channel, mask in self.channels.items()}
+
+    def get_selected(self, array, mask):
+        output = {"scale_factor": self.scale_factor[mask]}
+        for group, add_vars, mask_name in CutApplier.var_list:
+            if array is None:
+                break
+            if mask_name is not None:
+                # Preskimmed events have no object mask, they never pass
+                submask = Process.drop_none(self.arrays[mask_name][mask])
+                subarray = array[add_vars][submask]
+            else:
+                subarray = array[add_vars]
+
+            for var in add_vars:
+                if "var" in repr(ak.type(subarray[var])):
+                    awk_var = ak.ArrayBuilder()
+                    CutApplier.unMask(subarray[var], awk_var)
+                    var_arr = awk_var.snapshot()
+                    if "unknown" in repr(ak.type(var_arr)):
+                        # No objects to fill, typed as unMask fills them
+                        var_arr = ak.unflatten(np.zeros(0),
+                                               ak.to_numpy(ak.num(subarray[var])))
                 else:
-                    subarray = array[add_vars][mask]
-                    
-                for var in add_vars:
-                    dict_name = "{}/{}".format(group, var)
-                    if "var" in repr(ak.type(subarray[var])):
-                        awk_var = ak.ArrayBuilder()
-                        CutApplier.unMask(subarray[var], awk_var)
-                        var_arr = awk_var.snapshot()
-                    else:
-                        var_arr = subarray[var]
-                        
-                    self.output[dict_name] = ak.concatenate(
-                        [self.output[dict_name], var_arr])
-            start = end
+                    var_arr = subarray[var]
+                output["{}/{}".format(group, var)] = var_arr
+
+        for group, add_vars in CutApplier.der_var_list:
+            for var in add_vars:
+                output["{}/{}".format(group, var)] = self.arrays[var][mask]
+        return output
 
     @staticmethod
     @numba.jit(nopython=True)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+import uproot4 as uproot
+import glob
+import awkward1 as ak
+import numpy as np
+from python.Prefetcher import Prefetcher
+
+class EventReader:
+    prefetch = 0
+    memory_budget = 0
+    overhead = 2.
+    default_step = "100 MB"
+    config_list = ["prefetch", "memory_budget"]
+
+    @staticmethod
+    def iterate(filename, branches, entry_start=None, entry_stop=None, outputs=[]):
+        if EventReader.memory_budget > 0:
+            chunks = EventReader.iterate_budget(filename, branches, entry_start,
+                                                entry_stop, outputs)
+        elif entry_start is None and entry_stop is None:
+            chunks = uproot.iterate("{}:Events".format(filename), branches)
+        else:
+            tree = uproot.open(filename)["Events"]
+            chunks = tree.iterate(branches, entry_start=entry_start,
+                                  entry_stop=entry_stop)
+        return EventReader.read_ahead(chunks)
+
+    @staticmethod
+    def iterate_budget(filename, branches, entry_start, entry_stop, outputs):
+        # Each file with its own step
+        for name in EventReader.get_files(filename):
+            tree = EventReader.get_tree(name)
+            step = EventReader.get_step(tree, branches, outputs)
+            yield from tree.iterate(branches, entry_start=entry_start,
+                                    entry_stop=entry_stop, step_size=step)
+
+    @staticmethod
+    def get_step(tree, branches, outputs=[]):
+        # Entries per chunk so the chunk, the chunks read ahead and the job
+        # outputs of the chunk fit in the budget. Sizes come from the file,
+        # samples with big collections get smaller chunks
+        nevents = max(tree.num_entries, 1)
+        read_bytes = sum(tree[branch].uncompressed_bytes for branch in branches)/nevents
+        objects = dict()
+        for name in outputs:
+            collection = name.split("_")[0]
+            if collection not in objects:
+                objects[collection] = EventReader.get_multiplicity(tree, collection)
+        out_bytes = 8*sum(objects[name.split("_")[0]] for name in outputs)
+        event_bytes = EventReader.overhead*((1 + EventReader.prefetch)*read_bytes
+                                            + out_bytes)
+        step = max(int(EventReader.memory_budget/max(event_bytes, 1.)), 1)
+        print("{:.0f} bytes per event, {} events per chunk".format(event_bytes, step))
+        return step
+
+    @staticmethod
+    def get_entry_step(tree, branches):
+        # Entries per chunk as iterate reads them, uproot's default without
+        # a budget
+        if EventReader.memory_budget > 0:
+            return EventReader.get_step(tree, branches)
+        return max(tree.num_entries_for(EventReader.default_step, branches), 1)
+
+    @staticmethod
+    def get_multiplicity(tree, collection, sample=10000):
+        # Mean number of objects per event, 1 for event level columns
+        counter = "n{}".format(collection)
+        if counter not in tree:
+            return 1.
+        counts = tree[counter].array(entry_stop=sample, library="np")
+        return max(float(np.mean(counts)) if len(counts) > 0 else 0., 1.)
+
+    @staticmethod
+    def set_memory_budget(megabytes):
+        EventReader.memory_budget = megabytes*1024**2
+
+    @staticmethod
+    def read_ahead(chunks):
+        if EventReader.prefetch <= 0:
+            return chunks
+        return Prefetcher(chunks, EventReader.prefetch)
+
+    @staticmethod
+    def set_prefetch(depth):
+        EventReader.prefetch = depth
+
+    @staticmethod
+    def get_tree(filename):
+        return uproot.open(filename)["Events"]
+
+    @staticmethod
+    def get_entries(filename):
+        return EventReader.get_tree(filename).num_entries
+
+    @staticmethod
+    def read_entries(tree, branches, entries, step=None):
+        # Only clusters holding one of the (sorted) entries are read, runs of
+        # neighbouring clusters in one go, up to step entries per read
+        if len(entries) == 0:
+            return tree.arrays(branches, entry_start=0, entry_stop=0)
+        offsets = np.asarray(tree.common_entry_offsets(filter_name=branches))
+        clusters = np.unique(np.searchsorted(offsets, entries, side="right") - 1)
+        runs = np.split(clusters, np.nonzero(np.diff(clusters) > 1)[0] + 1)
+        ranges = list()
+        for run in runs:
+            first = 0
+            for last in range(1, len(run) + 1):
+                if (last == len(run) or step is not None and
+                        offsets[run[last] + 1] - offsets[run[first]] > step):
+                    ranges.append((offsets[run[first]], offsets[run[last - 1] + 1]))
+                    first = last
+        arrays = list()
+        for start, stop in ranges:
+            array = tree.arrays(branches, entry_start=start, entry_stop=stop)
+            in_run = entries[(entries >= start) & (entries < stop)]
+            arrays.append(array[in_run - start])
+        return arrays[0] if len(arrays) == 1 else ak.concatenate(arrays)
+
+    @staticmethod
+    def get_files(filename):
+        # In the order uproot globs them
+        return [filename] if EventReader.is_single(filename) else glob.glob(filename)
+
+    @staticmethod
+    def is_single(filename):
+        return not any(char in filename for char in "*?[")
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+
+import numba
+
+# Flat kernels are called with the flat content of every column of the job
+# (vals then addvals, each as a NumPy array), then the offsets of every
+# jagged layout in order of first appearance, then the output buffer.
+# Columns of one collection in vals share one offsets array, addvals share
+# one when they come from the same mask and parent mask.
+#
+# The output is preallocated with dtype, one entry per event or, with like,
+# one per object of that column (of each column in turn for a tuple, event
+# by event), and width entries each if given (a tuple for more dimensions). finish, if given, gets the whole filled buffer and
+# returns the array to store, for steps numpy does best on the full batch.
+class FlatKernel:
+    def __init__(self, func, dtype, like=None, width=None, finish=None):
+        self.kernel = numba.njit(func, nogil=True)
+        self.dtype = dtype
+        self.like = like
+        self.width = width
+        self.finish = finish
+
+    def __call__(self, *args):
+        return self.kernel(*args)
+
+def flat_kernel(dtype, like=None, width=None, finish=None):
+    return lambda func: FlatKernel(func, dtype, like, width, finish)
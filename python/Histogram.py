@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import awkward1 as ak
+import numpy as np
+
+# Bins are (nbins, low, high) or a list of edges. Every axis has an
+# underflow bin first and an overflow bin last, bins include their lower
+# edge. Object level values get the weight of their event.
+class Histogram:
+    def __init__(self, name, expr, bins, expr_y=None, bins_y=None):
+        self.name = name
+        self.exprs = [expr]
+        self.edges = [Histogram.get_edges(bins)]
+        if expr_y is not None:
+            self.exprs.append(expr_y)
+            self.edges.append(Histogram.get_edges(bins_y))
+        shape = tuple(len(edges) + 1 for edges in self.edges)
+        self.sumw = np.zeros(shape)
+        self.sumw2 = np.zeros(shape)
+
+    @staticmethod
+    def get_edges(bins):
+        if isinstance(bins, tuple):
+            nbins, low, high = bins
+            return np.linspace(low, high, nbins + 1)
+        return np.asarray(bins, dtype=np.float64)
+
+    def fill(self, values, weight):
+        arrays = ak.broadcast_arrays(weight, *values)
+        arrays = [ak.to_numpy(ak.flatten(array, axis=None)) for array in arrays]
+        index = np.zeros(len(arrays[0]), dtype=np.int64)
+        for edges, value in zip(self.edges, arrays[1:]):
+            index = index*(len(edges) + 1) + np.searchsorted(edges, value, side="right")
+        weight = arrays[0].astype(np.float64)
+        size = self.sumw.size
+        self.sumw += np.bincount(index, weights=weight,
+                                 minlength=size).reshape(self.sumw.shape)
+        self.sumw2 += np.bincount(index, weights=weight**2,
+                                  minlength=size).reshape(self.sumw.shape)
+
+    @staticmethod
+    def write(hists, filename):
+        arrays = dict()
+        for hist in hists:
+            arrays["{}/sumw".format(hist.name)] = hist.sumw
+            arrays["{}/sumw2".format(hist.name)] = hist.sumw2
+            for axis, edges in enumerate(hist.edges):
+                arrays["{}/edges{}".format(hist.name, axis)] = edges
+        np.savez(filename, **arrays)
+
+    @staticmethod
+    def merge(filenames, output):
+        merged = dict()
+        for filename in filenames:
+            with np.load(filename) as arrays:
+                for key in arrays.files:
+                    if key not in merged or "/edges" in key:
+                        merged[key] = arrays[key]
+                    else:
+                        merged[key] = merged[key] + arrays[key]
+        np.savez(output, **merged)
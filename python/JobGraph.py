@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+import time
+import re
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import wait, FIRST_COMPLETED
+from python.ChunkBuffer import ChunkBuffer
+
+class JobGraph:
+    def __init__(self, processes, executor=None):
+        self.executor = executor
+        self.jobs = OrderedDict()
+        for process in processes:
+            for job in process.extraFuncs:
+                self.jobs[job[1]] = (process, job)
+        for process in processes:
+            for name, node in process.mask_tree.items():
+                if node.parent is None:
+                    raise ValueError("JobGraph: mask {} is used but no job "
+                                     "makes it".format(name))
+
+        self.depends = {name: self.find_depends(*self.jobs[name])
+                        for name in self.jobs}
+        self.order = self.sort(self.jobs)
+        self.timing = {name: 0. for name in self.jobs}
+        self.skims = list()
+        self.events = [0, 0]
+
+    def find_depends(self, process, job):
+        _, _, inmask, _, addvals = job
+        needed = set()
+        for mask_name in inmask:
+            needed |= set(process.get_masks(mask_name))
+        for addval, mask in addvals.items():
+            needed.add(addval)
+            if mask is not None:
+                needed |= set(process.get_masks(mask))
+        return {name for name in needed if name in self.jobs}
+
+    def sort(self, names, done=None):
+        done = list() if done is None else done
+        order = list()
+        remaining = [name for name in self.jobs if name in names]
+        while remaining:
+            ready = [name for name in remaining
+                     if self.depends[name] <= set(order) | set(done)]
+            if len(ready) == 0:
+                raise ValueError("JobGraph: circular dependency between {}"
+                                 .format(remaining))
+            order += ready
+            remaining = [name for name in remaining if name not in ready]
+        return order
+
+    def get_runs(self):
+        # Ready jobs of one process at a time, for reading the file once per
+        # process. A process with jobs waiting on a later one runs again
+        processes = list()
+        for process, _ in self.jobs.values():
+            if process not in processes:
+                processes.append(process)
+        runs, done = list(), list()
+        while len(done) < len(self.jobs):
+            found = False
+            for process in processes:
+                names = [name for name in self.jobs
+                         if self.jobs[name][0] is process and name not in done]
+                run = list()
+                ready = True
+                while ready:
+                    ready = [name for name in names if name not in run
+                             and self.depends[name] <= set(done + run)]
+                    run += ready
+                if run:
+                    runs.append((process, [self.jobs[name][1] for name in run]))
+                    done += run
+                    found = True
+            if not found:
+                raise ValueError("JobGraph: circular dependency between {}".format(
+                    [name for name in self.jobs if name not in done]))
+        return runs
+
+    def get_ancestors(self, needed):
+        keep = set()
+        work = [name for name in needed if name in self.jobs]
+        while work:
+            name = work.pop()
+            if name not in keep:
+                keep.add(name)
+                work += list(self.depends[name])
+        return keep
+
+    def get_names(self, cut):
+        return {name for name in re.findall(r"\w+", cut) if name in self.jobs}
+
+    def prune(self, needed):
+        keep = self.get_ancestors(needed)
+        dropped = [name for name in self.order if name not in keep]
+        for name in dropped:
+            process, _ = self.jobs.pop(name)
+            del process.outmasks[name]
+            del self.depends[name]
+            del self.timing[name]
+        self.order = [name for name in self.order if name in keep]
+        return dropped
+
+    def get_stale(self, columns, hashes):
+        # Jobs with no stored output or whose hash changed, and every job
+        # reading one of them. Stored outputs without a hash are trusted
+        stale = set()
+        for name in self.order:
+            process, job = self.jobs[name]
+            new_hash = process.get_hash(job)
+            if (name not in columns or hashes.get(name, new_hash) != new_hash
+                    or self.depends[name] & stale):
+                stale.add(name)
+        return stale
+
+    def reuse(self, stale, load, load_all=False):
+        # Only stale jobs run, the stored outputs they read (or all of them)
+        # come from load
+        inputs = set()
+        for name in stale:
+            inputs |= self.depends[name] - stale
+        for name in [name for name in self.order if name not in stale]:
+            process, job = self.jobs.pop(name)
+            if name in inputs or load_all:
+                process.outmasks[name] = ChunkBuffer(process.restore_shape(job, load(name)))
+            else:
+                del process.outmasks[name]
+            del self.depends[name]
+            del self.timing[name]
+        for name in stale:
+            self.depends[name] &= stale
+        self.order = [name for name in self.order if name in stale]
+        return inputs
+
+    def set_skims(self, cut_list, weights=()):
+        # Jobs making the weights go first so skimmed events keep theirs in
+        # the cutflow, then the jobs feeding the skims, in the order the
+        # skims are given. Each skim runs right after the last job it reads,
+        # and after the skim before it, and every later job only sees the
+        # events passing it.
+        order = self.sort(self.get_ancestors(weights))
+        for cut in cut_list:
+            ancestors = self.get_ancestors(self.get_names(cut)) - set(order)
+            order += self.sort(ancestors, order)
+        self.order = order + self.sort(set(self.jobs) - set(order), order)
+
+        self.skims = list()
+        position = -1
+        for cut in cut_list:
+            needed = self.get_names(cut)
+            if len(needed) == 0:
+                raise ValueError("JobGraph: skim {} reads no job output".format(cut))
+            position = max([self.order.index(name) for name in needed] + [position])
+            self.skims.append((position, cut, needed))
+
+    def get_levels(self):
+        # Number of skims run before each job, its output is None for the
+        # events they dropped
+        return {name: sum(1 for position, _, _ in self.skims if position < idx)
+                for idx, name in enumerate(self.order)}
+
+    def get_all_vars(self):
+        allvars = set()
+        for _, job in self.jobs.values():
+            allvars |= set(job[3])
+        return allvars
+
+    def run_chunk(self, array, start, end):
+        entries, skim = None, 0
+        if self.executor is None:
+            for idx, name in enumerate(self.order):
+                while skim < len(self.skims) and self.skims[skim][0] < idx:
+                    entries = self.run_skim(self.skims[skim], entries, start, end)
+                    skim += 1
+                self.run_job(name, array, start, end, entries)
+        else:
+            finished = set()
+            running = dict()
+            waiting = list(range(len(self.order)))
+            while waiting or running:
+                while (skim < len(self.skims)
+                       and set(self.order[:self.skims[skim][0] + 1]) <= finished):
+                    entries = self.run_skim(self.skims[skim], entries, start, end)
+                    skim += 1
+                # A job waits for every skim placed before it in self.order
+                last = len(self.order) if skim == len(self.skims) else self.skims[skim][0]
+                for idx in [idx for idx in waiting if idx <= last
+                            and self.depends[self.order[idx]] <= finished]:
+                    future = self.executor.submit(self.run_job, self.order[idx],
+                                                  array, start, end, entries)
+                    running[future] = self.order[idx]
+                    waiting.remove(idx)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                    finished.add(running.pop(future))
+
+        for process, _ in self.jobs.values():
+            process.mask_cache.clear()
+        self.events[0] += end - start
+        self.events[1] += end - start if entries is None else len(entries)
+
+    def run_job(self, name, array, start, end, entries=None):
+        process, job = self.jobs[name]
+        begin = time.perf_counter()
+        process.run_job(job, array, start, end, entries)
+        self.timing[name] += time.perf_counter() - begin
+
+    def run_skim(self, skim, entries, start, end):
+        _, cut, needed = skim
+        process, _ = self.jobs[next(iter(needed))]
+        passed = process.eval_cut(cut, needed, start, end, entries)
+        if entries is None:
+            entries = np.arange(end - start)
+        return entries[passed]
+
+    def critical_path(self):
+        length, previous = dict(), dict()
+        for name in self.order:
+            prev = max(self.depends[name], key=lambda dep: length[dep], default=None)
+            previous[name] = prev
+            length[name] = self.timing[name] + (0 if prev is None else length[prev])
+
+        name = max(length, key=length.get, default=None)
+        total = 0 if name is None else length[name]
+        path = list()
+        while name is not None:
+            path.append(name)
+            name = previous[name]
+        return total, path[::-1]
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+import re
+import json
+import awkward1 as ak
+import numpy as np
+import pyarrow
+from python.Process import Process
+
+# Stores the object masks of a collection as one integer per object, bit
+# k set if the object passes mask k and every mask above it in the mask
+# tree, like GETMASK/READFROM. The layout, {packed column: [[mask, parent,
+# bit], ...]} with parent None at the top, goes in the parquet metadata.
+# Events dropped by --preskim from any packed mask are None for all of them.
+class MaskPacker:
+    max_bits = 64
+
+    @staticmethod
+    def get_layout(columns, mask_tree):
+        # Jagged boolean masks whose parents are packed in the same collection,
+        # parents first
+        def is_mask(name):
+            return (name in columns and name in mask_tree and re.fullmatch(
+                r"\d+ \* (option\[)?var \* bool\]?", repr(ak.type(columns[name]))))
+
+        layout = dict()
+        for name in columns:
+            if not is_mask(name):
+                continue
+            chain = [node.name for node in mask_tree[name].path if node.name != "base"]
+            collection = name.split("_")[0]
+            if not all(is_mask(mask) and mask.split("_")[0] == collection
+                       for mask in chain):
+                continue
+            packed = "{}_packedMasks".format(collection)
+            masks = layout.setdefault(packed, list())
+            for mask in chain:
+                if len(masks) < MaskPacker.max_bits and mask not in [m[0] for m in masks]:
+                    parent = mask_tree[mask].parent
+                    parent = None if parent is None or parent.name == "base" else parent.name
+                    masks.append([mask, parent, len(masks)])
+        return {packed: masks for packed, masks in layout.items()
+                if all(parent is None or parent in [m[0] for m in masks]
+                       for _, parent, _ in masks)}
+
+    @staticmethod
+    def pack(columns, layout):
+        columns = dict(columns)
+        for packed, masks in layout.items():
+            valid = np.ones(len(columns[masks[0][0]]), dtype=bool)
+            for name, _, _ in masks:
+                valid &= ~ak.to_numpy(ak.is_none(columns[name]))
+            dtype = MaskPacker.get_dtype(len(masks))
+
+            absolute, counts, out = dict(), None, None
+            for name, parent, bit in masks:
+                mask = Process.drop_none(columns.pop(name)[valid])
+                flat = ak.to_numpy(ak.flatten(mask)).astype(bool)
+                if parent is None:
+                    if counts is None:
+                        counts = ak.to_numpy(ak.num(mask))
+                        out = np.zeros(len(flat), dtype=dtype)
+                    elif not np.array_equal(counts, ak.to_numpy(ak.num(mask))):
+                        raise ValueError("MaskPacker: {} does not match the objects "
+                                         "of {}".format(name, packed))
+                    absolute[name] = flat
+                else:
+                    parent_abs = absolute[parent]
+                    if len(flat) != np.count_nonzero(parent_abs):
+                        raise ValueError("MaskPacker: {} does not match the objects "
+                                         "passing {}".format(name, parent))
+                    absolute[name] = np.zeros(len(parent_abs), dtype=bool)
+                    absolute[name][parent_abs] = flat
+                out |= absolute[name].astype(dtype) << dtype(bit)
+            columns[packed] = MaskPacker.restore(ak.unflatten(out, counts), valid)
+        return columns
+
+    @staticmethod
+    def unpack(packed, masks, names):
+        # Vectorized decode of the masks in names from one packed column
+        valid = ~ak.to_numpy(ak.is_none(packed))
+        projected = Process.drop_none(packed[valid])
+        flat = ak.to_numpy(ak.flatten(projected))
+        nobjects = ak.to_numpy(ak.num(projected))
+        event = np.repeat(np.arange(len(nobjects)), nobjects)
+        bits = {name: (parent, bit) for name, parent, bit in masks}
+
+        out = dict()
+        for name in names:
+            parent, bit = bits[name]
+            mask = (flat >> bit) & 1 == 1
+            if parent is None:
+                out[name] = MaskPacker.restore(ak.unflatten(mask, nobjects), valid)
+                continue
+            parent_abs = (flat >> bits[parent][1]) & 1 == 1
+            counts = np.bincount(event[parent_abs], minlength=len(nobjects))
+            out[name] = MaskPacker.restore(ak.unflatten(mask[parent_abs], counts), valid)
+        return out
+
+    @staticmethod
+    def unpack_mask(packed, masks, name):
+        return MaskPacker.unpack(packed, masks, [name])[name]
+
+    @staticmethod
+    def restore(array, valid):
+        if valid.all():
+            return array
+        index = np.full(len(valid), -1, dtype=np.int64)
+        index[valid] = np.arange(np.count_nonzero(valid))
+        return ak.Array(ak.layout.IndexedOptionArray64(ak.layout.Index64(index),
+                                                       ak.to_layout(array)))
+
+    @staticmethod
+    def get_dtype(nbits):
+        for dtype in [np.uint8, np.uint16, np.uint32, np.uint64]:
+            if nbits <= 8*np.dtype(dtype).itemsize:
+                return dtype
+
+    @staticmethod
+    def read_layout(schema):
+        metadata = schema.metadata or dict()
+        if b"packed_masks" not in metadata:
+            return dict()
+        return json.loads(metadata[b"packed_masks"])
+
+    @staticmethod
+    def to_table(columns, layout):
+        names = list(columns.keys())
+        table = pyarrow.Table.from_arrays([ak.to_arrow(columns[name]) for name in names],
+                                          names=names)
+        if len(layout) > 0:
+            table = table.replace_schema_metadata(
+                {"packed_masks": json.dumps(layout)})
+        return table
+
+    @staticmethod
+    def unpack_table(table):
+        # The masks of every packed column back as their own columns
+        layout = MaskPacker.read_layout(table.schema)
+        for packed, masks in layout.items():
+            array = ak.from_arrow(table.column(packed))
+            unpacked = MaskPacker.unpack(array, masks, [mask[0] for mask in masks])
+            table = table.remove_column(table.column_names.index(packed))
+            for name, mask in unpacked.items():
+                table = table.append_column(name, ak.to_arrow(mask))
+        return table.replace_schema_metadata(None)
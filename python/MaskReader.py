@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import awkward1 as ak
+import pyarrow
+import pyarrow.parquet
+from python.MaskPacker import MaskPacker
+from python.Preskim import Preskim
+
+# Reads the columns of a mask file that apply needs, one row group at a
+# time. read(n) gives the next n rows so masks stay in step with the
+# chunks of the event file, iterating gives whole row groups or step rows
+# at a time.
+class MaskReader:
+    def __init__(self, filename, columns, entry_start=None, entry_stop=None):
+        self.file = pyarrow.parquet.ParquetFile(filename)
+        self.columns = [name for name in self.file.schema_arrow.names
+                        if name in columns]
+        # Masks packed by collection are decoded from their packed column
+        self.layout = MaskPacker.read_layout(self.file.schema_arrow)
+        self.unpack = dict()
+        for packed, masks in self.layout.items():
+            names = [name for name, _, _ in masks if name in columns]
+            if len(names) > 0:
+                self.unpack[packed] = names
+                self.columns.append(packed)
+        # Masks of events dropped by --preskim are filled, Event_preskim
+        # tells which
+        self.levels = Preskim.read_levels(self.file.schema_arrow)
+        if self.levels is not None:
+            self.columns.append(Preskim.column)
+        nrows = self.file.metadata.num_rows
+        self.entry_start = 0 if entry_start is None else entry_start
+        self.entry_stop = nrows if entry_stop is None else min(entry_stop, nrows)
+        self.num_entries = self.entry_stop - self.entry_start
+
+        # Skip the row groups before entry_start
+        self.group, self.position = 0, 0
+        while self.group < self.file.num_row_groups:
+            group_rows = self.file.metadata.row_group(self.group).num_rows
+            if self.position + group_rows > self.entry_start:
+                break
+            self.position += group_rows
+            self.group += 1
+        self.skip = self.entry_start - self.position
+        self.buffer = list()
+        self.buffered = 0
+        self.remaining = self.num_entries
+
+    def fill(self, nrows):
+        while self.buffered < nrows and self.group < self.file.num_row_groups:
+            table = self.file.read_row_group(self.group, columns=self.columns)
+            self.group += 1
+            if self.skip > 0:
+                table = table.slice(self.skip)
+                self.skip = 0
+            self.buffer.append(table)
+            self.buffered += len(table)
+
+    def read(self, nrows):
+        nrows = min(nrows, self.remaining)
+        self.fill(nrows)
+        table = pyarrow.concat_tables(self.buffer)
+        self.buffer = [table.slice(nrows)]
+        self.buffered -= nrows
+        self.remaining -= nrows
+        arrays = ak.from_arrow(table.slice(0, nrows))
+        if len(self.unpack) == 0 and self.levels is None:
+            return arrays
+        fields = {name: arrays[name] for name in ak.fields(arrays)}
+        if self.levels is not None:
+            fields = Preskim.restore(fields, self.levels)
+        for packed, names in self.unpack.items():
+            fields.update(MaskPacker.unpack(fields.pop(packed), self.layout[packed], names))
+        return ak.zip(fields, depth_limit=1)
+
+    def iterate(self, step=None):
+        while self.remaining > 0:
+            if step is None:
+                self.fill(1)
+                yield self.read(self.buffered)
+            else:
+                yield self.read(step)
+
+    def __iter__(self):
+        return self.iterate()
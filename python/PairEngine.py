@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import awkward1 as ak
+import numpy as np
+
+# Pairs of objects in the same event, kept as flat indices into the
+# flattened collections so masses of every pair are one numpy expression.
+# The first object of a pair comes from the selected objects of its
+# collection (all of them if no selection is given), the second from all
+# objects of the other collection, an object is never paired with itself.
+class PairEngine:
+    def __init__(self):
+        self.collections = dict()
+        self.nevents = None
+
+    def add_collection(self, name, pt, eta, phi, charge, select=None):
+        counts = ak.to_numpy(ak.num(pt))
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        if select is None:
+            select = ak.local_index(pt)
+        self.collections[name] = {
+            "offsets": offsets,
+            "select": select,
+            "local": ak.local_index(pt),
+            "pt": ak.to_numpy(ak.flatten(pt)).astype(np.float64),
+            "eta": ak.to_numpy(ak.flatten(eta)).astype(np.float64),
+            "phi": ak.to_numpy(ak.flatten(phi)).astype(np.float64),
+            "charge": ak.to_numpy(ak.flatten(charge)),
+        }
+        self.nevents = len(counts)
+
+    def get_pairs(self, first, second, opposite_sign=True):
+        coll1, coll2 = self.collections[first], self.collections[second]
+        pairs = ak.cartesian([coll1["select"], coll2["local"]])
+        event = np.repeat(np.arange(self.nevents), ak.to_numpy(ak.num(pairs)))
+        local1, local2 = ak.unzip(pairs)
+        idx1 = coll1["offsets"][event] + ak.to_numpy(ak.flatten(local1))
+        idx2 = coll2["offsets"][event] + ak.to_numpy(ak.flatten(local2))
+
+        keep = np.ones(len(event), dtype=bool)
+        if first == second:
+            keep &= idx1 != idx2
+        if opposite_sign:
+            keep &= coll1["charge"][idx1]*coll2["charge"][idx2] <= 0
+        return event[keep], idx1[keep], idx2[keep]
+
+    def get_mass2(self, first, second, idx1, idx2):
+        # Massless invariant mass squared
+        coll1, coll2 = self.collections[first], self.collections[second]
+        return 2*coll1["pt"][idx1]*coll2["pt"][idx2]*(
+            np.cosh(coll1["eta"][idx1] - coll2["eta"][idx2])
+            - np.cos(coll1["phi"][idx1] - coll2["phi"][idx2]))
+
+    def any_in_windows(self, pair_types, windows, opposite_sign=True):
+        # True for events with a pair of any of pair_types whose mass squared
+        # is strictly inside any of windows
+        found = np.zeros(self.nevents, dtype=bool)
+        for first, second in pair_types:
+            event, idx1, idx2 = self.get_pairs(first, second, opposite_sign)
+            mass2 = self.get_mass2(first, second, idx1, idx2)
+            inside = np.zeros(len(event), dtype=bool)
+            for low, high in windows:
+                inside |= (mass2 > low) & (mass2 < high)
+            found[event[inside]] = True
+        return found
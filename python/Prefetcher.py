@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Reads the next depth chunks of an iterator on a background thread while
+# the current one is used. Errors of the read come out where the chunk
+# would have.
+class Prefetcher:
+    def __init__(self, chunks, depth=1):
+        self.chunks = iter(chunks)
+        self.depth = depth
+
+    def __iter__(self):
+        executor = ThreadPoolExecutor(1)
+        pending = deque(executor.submit(next, self.chunks, None)
+                        for _ in range(self.depth))
+        try:
+            while True:
+                chunk = pending.popleft().result()
+                if chunk is None:
+                    return
+                pending.append(executor.submit(next, self.chunks, None))
+                yield chunk
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import json
+import awkward1 as ak
+import numpy as np
+from python.Process import Process
+from python.MaskPacker import MaskPacker
+
+# Masks made after a --preskim skim are None for the events it dropped,
+# which parquet can't store for jagged columns. They are written as empty
+# lists or zeros instead. Event_preskim holds the number of skims each event
+# passed and the parquet metadata, {mask: skims}, how many skims ran before
+# each mask, so reading gives the Nones back.
+class Preskim:
+    column = "Event_preskim"
+
+    @staticmethod
+    def get_levels(levels, layout):
+        # A packed column is None where any of its masks is
+        levels = {name: level for name, level in levels.items() if level > 0}
+        for packed, masks in layout.items():
+            level = max(levels.pop(name, 0) for name, _, _ in masks)
+            if level > 0:
+                levels[packed] = level
+        return levels
+
+    @staticmethod
+    def fill(columns, levels):
+        nevents = len(next(iter(columns.values())))
+        passed = np.zeros(nevents, dtype=np.uint8)
+        for name, level in levels.items():
+            valid = ~ak.to_numpy(ak.is_none(columns[name]))
+            passed[valid] = np.maximum(passed[valid], level)
+        columns = {name: Preskim.fill_none(array, passed >= levels[name])
+                   if name in levels else array for name, array in columns.items()}
+        columns[Preskim.column] = ak.Array(passed)
+        return columns
+
+    @staticmethod
+    def fill_none(array, valid):
+        kept = Process.drop_none(array[valid])
+        if isinstance(ak.type(kept).type, ak.types.ListType):
+            counts = np.zeros(len(valid), dtype=np.int64)
+            counts[valid] = ak.to_numpy(ak.num(kept))
+            return ak.unflatten(ak.flatten(kept, axis=1), counts)
+        kept = ak.to_numpy(kept)
+        out = np.zeros((len(valid),) + kept.shape[1:], dtype=kept.dtype)
+        out[valid] = kept
+        return Process.wrap_flat(out)
+
+    @staticmethod
+    def restore(columns, levels):
+        passed = ak.to_numpy(columns.pop(Preskim.column))
+        for name, level in levels.items():
+            if name in columns:
+                valid = passed >= level
+                columns[name] = MaskPacker.restore(
+                    Process.drop_none(columns[name][valid]), valid)
+        return columns
+
+    @staticmethod
+    def set_levels(table, levels):
+        metadata = dict(table.schema.metadata or dict())
+        metadata[b"preskim_levels"] = json.dumps(levels)
+        return table.replace_schema_metadata(metadata)
+
+    @staticmethod
+    def read_levels(schema):
+        metadata = schema.metadata or dict()
+        if b"preskim_levels" not in metadata:
+            return None
+        return json.loads(metadata[b"preskim_levels"])
@@ -4,18 +4,31 @@ import uproot4 as uproot
 import awkward1 as ak
 import numpy as np
 import numba
+import hashlib
+import inspect
+import os
 from anytree import Node
 from collections import OrderedDict
+from python.ChunkBuffer import ChunkBuffer
+from python.EventReader import EventReader
+from python.FlatKernel import FlatKernel
+from python.ScaleFactor import ScaleFactor
 
 class Process:
-    def __init__(self, process = None):
+    top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    def __init__(self, process = None, year = 2016):
         self.extraFuncs = list()
         if process is None:
             self.outmasks = dict()
             self.mask_tree = dict()
+            self.mask_cache = dict()
+            self.year = year
         else:
             self.outmasks = process.outmasks
             self.mask_tree = process.mask_tree
+            self.mask_cache = process.mask_cache
+            self.year = process.year
 
     def __iadd__(self, other):
         if isinstance(other, Process):
@@ -30,20 +43,21 @@ class Process:
 
     def add_job(self, func, outmask, vals=[], inmask=None, addvals=[]):
         inmask_dict = dict()
+        node = self.get_node(outmask)
         if isinstance(inmask, list):
             for mask in inmask:
                 key = mask.split("_")[0] + "_"
                 var_apply = [col for col in vals if key in col]
                 inmask_dict[mask] = var_apply
-                self.mask_tree[outmask] = Node(outmask, self.mask_tree[mask])
+                node.parent = self.get_node(mask)
         elif isinstance(inmask, str):
             key = inmask.split("_")[0] + "_"
             var_apply = [col for col in vals if key in col]
             inmask_dict[inmask] = var_apply
-            self.mask_tree[outmask] = Node(outmask, self.mask_tree[inmask])
+            node.parent = self.get_node(inmask)
         elif inmask is None:
-            self.mask_tree[outmask] = Node(outmask, Node("base"))
-        self.outmasks[outmask] = ak.Array([])
+            node.parent = Node("base")
+        self.outmasks[outmask] = ChunkBuffer()
         addvals_dict = OrderedDict()
         for mask, additions in addvals:
             if isinstance(additions, str):
@@ -54,54 +68,301 @@ class Process:
 
         self.extraFuncs.append((func, outmask, inmask_dict, vals, addvals_dict))
 
-    def run(self, filename):
-        allvars = self.get_all_vars()
+    def run(self, filename, entry_start=None, entry_stop=None, jobs=None):
+        jobs = self.extraFuncs if jobs is None else jobs
+        allvars = self.get_all_vars(jobs)
         start, end = 0, 0
-        for array in uproot.iterate("{}:Events".format(filename), allvars):
+        outputs = [job[1] for job in jobs]
+        for array in EventReader.iterate(filename, allvars, entry_start, entry_stop,
+                                         outputs):
             end += len(array)
             print("Events considered: ", end)
-            for func, write_name, inmask, var, addvals in self.extraFuncs:
-                events = array[var]
-                for mask_name, vals in inmask.items():
-                    submasks = self.get_masks(mask_name, start, end)
-                    for submask in submasks:
-                        for col in vals:
-                            events[col] = events[col][self.outmasks[submask][start:end]]
-                
-                for addval, mask in addvals.items():
-                    events[addval] = self.add_var(mask, addval, start, end)
-
-                # For different runtypes
-                final_mask = None
-                if self.isJit(func):
-                    mask = ak.ArrayBuilder()
-                    getattr(self, func)(events, mask)
-                    final_mask = mask.snapshot()
-                elif self.isVectorize(func):
-                    variables = [events[col] for col in var+list(addvals.keys())]
-                    # print([ak.type(v[0]) for v in variables])
-                    final_mask = getattr(self, func)(*variables)
-                else:
-                    final_mask = getattr(self, func)(events[var])
-                
-                self.outmasks[write_name] = ak.concatenate(
-                    [self.outmasks[write_name], final_mask])
-                                
+            self.run_chunk(array, start, end, jobs)
             start = end
-            
-    def get_all_vars(self):
+
+    def run_chunk(self, array, start, end, jobs=None):
+        for job in self.extraFuncs if jobs is None else jobs:
+            self.run_job(job, array, start, end)
+        self.mask_cache.clear()
+
+    def run_job(self, job, array, start, end, entries=None):
+        func, write_name, inmask, var, addvals = job
+        events = array[var]
+        if entries is not None:
+            events = events[entries]
+        for mask_name, vals in inmask.items():
+            if len(vals) == 0:
+                continue
+            selection = self.get_selection(self.get_masks(mask_name), start,
+                                           end, entries)
+            for col in vals:
+                events[col] = events[col][selection]
+
+        for addval, mask in addvals.items():
+            events[addval] = self.add_var(mask, addval, start, end, entries)
+
+        # For different runtypes
+        final_mask = None
+        if self.isScaleFactor(func):
+            final_mask = ScaleFactor.tables[func](*[events[col] for col in var])
+        elif self.isFlat(func):
+            columns = [(col, col.split("_")[0], events[col]) for col in var]
+            columns += [(col, (mask, self.mask_tree[col].parent.name), events[col])
+                        for col, mask in addvals.items()]
+            final_mask = Process.run_flat(getattr(self, func), columns, len(events))
+        elif self.isJit(func):
+            mask = ak.ArrayBuilder()
+            getattr(self, func)(events, mask)
+            final_mask = mask.snapshot()
+        elif self.isVectorize(func):
+            variables = [events[col] for col in var+list(addvals.keys())]
+            # print([ak.type(v[0]) for v in variables])
+            final_mask = getattr(self, func)(*variables)
+        else:
+            final_mask = getattr(self, func)(events)
+
+        if entries is not None:
+            # Map back onto the full chunk, skimmed events become None
+            index = np.full(end - start, -1, dtype=np.int64)
+            index[entries] = np.arange(len(entries))
+            final_mask = ak.Array(ak.layout.IndexedOptionArray64(
+                ak.layout.Index64(index), ak.to_layout(final_mask)))
+        self.outmasks[write_name].append(final_mask)
+
+    def get_column(self, name, start, end, entries=None):
+        column = self.outmasks[name][start:end]
+        if entries is None:
+            return column
+        return Process.drop_none(column[entries])
+
+    def get_selection(self, path, start, end, entries=None):
+        # Compose the masks along path into one index into the unmasked
+        # objects. Kept until the end of the chunk, entries only shrink
+        # within a chunk so its length tells the skims apart
+        key = (tuple(path), None if entries is None else len(entries))
+        if key not in self.mask_cache:
+            selection = None
+            for name in path:
+                mask = self.get_column(name, start, end, entries)
+                if selection is None:
+                    selection = ak.local_index(mask)[mask]
+                else:
+                    selection = selection[mask]
+            self.mask_cache[key] = selection
+        return self.mask_cache[key]
+
+    def eval_cut(self, cut, names, start, end, entries=None):
+        columns = {name: self.get_column(name, start, end, entries) for name in names}
+        columns.update({"ak": ak, "np": np})
+        return ak.to_numpy(ak.fill_none(eval(cut, columns), False))
+
+    @staticmethod
+    def run_flat(kernel, columns, nevents):
+        contents = list()
+        offsets = OrderedDict()
+        for _, key, column in columns:
+            if "var" in repr(ak.type(column)):
+                if key not in offsets:
+                    counts = ak.to_numpy(ak.num(column))
+                    offsets[key] = np.zeros(len(counts) + 1, dtype=np.int64)
+                    np.cumsum(counts, out=offsets[key][1:])
+                column = ak.flatten(column)
+            contents.append(ak.to_numpy(column))
+
+        out_offsets = None
+        length = nevents
+        if kernel.like is not None:
+            likes = [kernel.like] if isinstance(kernel.like, str) else kernel.like
+            out_offsets = sum(offsets[[key for name, key, _ in columns if name == like][0]]
+                              for like in likes)
+            length = out_offsets[-1]
+        shape = (length,)
+        if isinstance(kernel.width, int):
+            shape += (kernel.width,)
+        elif kernel.width is not None:
+            shape += tuple(kernel.width)
+        out = np.zeros(shape, dtype=kernel.dtype)
+        kernel(*contents, *offsets.values(), out)
+        if kernel.finish is not None:
+            out = np.ascontiguousarray(kernel.finish(out))
+        return Process.wrap_flat(out, out_offsets)
+
+    @staticmethod
+    def wrap_flat(out, out_offsets=None):
+        # Wrap the buffer as is, nothing is copied
+        layout = ak.layout.NumpyArray(out.reshape(-1))
+        for size in out.shape[:0:-1]:
+            layout = ak.layout.RegularArray(layout, size)
+        if out_offsets is not None:
+            layout = ak.layout.ListOffsetArray64(ak.layout.Index64(out_offsets),
+                                                 layout)
+        return ak.Array(layout)
+
+    def restore_shape(self, job, array):
+        # Fixed size dimensions of a flat kernel output come back from
+        # parquet as lists, later kernels index them as arrays
+        func = job[0]
+        if self.isScaleFactor(func) or not self.isFlat(func):
+            return array
+        kernel = getattr(self, func)
+        shape = (0,)
+        if isinstance(kernel.width, int):
+            shape += (kernel.width,)
+        elif kernel.width is not None:
+            shape += tuple(kernel.width)
+        if kernel.finish is not None:
+            shape = np.shape(kernel.finish(np.zeros(shape, dtype=kernel.dtype)))
+        if len(shape) == 1 or isinstance(ak.type(array).type, ak.types.OptionType):
+            return array
+
+        out_offsets = None
+        if kernel.like is not None:
+            out_offsets = np.zeros(len(array) + 1, dtype=np.int64)
+            np.cumsum(ak.to_numpy(ak.num(array)), out=out_offsets[1:])
+            array = ak.flatten(array)
+        out = ak.to_numpy(ak.flatten(array, axis=None)).reshape((-1,) + shape[1:])
+        return Process.wrap_flat(out, out_offsets)
+
+    @staticmethod
+    def drop_none(column):
+        # Only call on rows that were kept by every skim, so no None is lost
+        if isinstance(ak.type(column).type, ak.types.OptionType):
+            return ak.Array(column.layout.project())
+        return column
+
+    def get_hash(self, job):
+        # Changes with the columns and masks of the job, the year and the
+        # code making it: its source, the constants frozen into it and what
+        # it reads by name, from this process, its globals or the classes
+        # and modules of this repo. Functions of this repo found that way
+        # are followed, tables named by a string are hashed by content
+        func, outmask, inmask, var, addvals = job
+        parts = [func, outmask, sorted(inmask.items()), var, list(addvals.items()),
+                 self.year]
+        if self.isScaleFactor(func):
+            parts += Process.get_table_code(ScaleFactor.tables[func])
+        else:
+            parts += Process.get_code(getattr(self, func), self)
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    @staticmethod
+    def get_table_code(table):
+        code = [table.values.tobytes(), table.absolute, table.side, table.overflow]
+        return code + [edges.tobytes() for edges in table.edges]
+
+    @staticmethod
+    def get_code(func, owner=None, seen=None):
+        seen = set() if seen is None else seen
+        if isinstance(func, FlatKernel):
+            code = [func.dtype, func.like, func.width]
+            if func.finish is not None:
+                code += Process.get_code(func.finish, owner, seen)
+            return Process.get_code(func.kernel, owner, seen) + code
+        func = Process.get_function(func)
+        if func in seen:
+            return list()
+        seen.add(func)
+        code = [inspect.getsource(func)]
+        for cell in func.__closure__ or []:
+            value = cell.cell_contents
+            if callable(value) and not isinstance(value, ScaleFactor):
+                code += Process.get_code(value, owner, seen)
+            else:
+                code += Process.get_value_code(value, owner, seen)
+
+        names = sorted(Process.get_names(func.__code__))
+        scopes = [func.__globals__[name] for name in names
+                  if (inspect.isclass(func.__globals__.get(name))
+                      or inspect.ismodule(func.__globals__.get(name)))
+                  and Process.is_local(func.__globals__[name])]
+        if owner is not None:
+            scopes.append(owner)
+        for name in names:
+            values = [func.__globals__[name]] if name in func.__globals__ else list()
+            values += [getattr(scope, name) for scope in scopes if hasattr(scope, name)]
+            for value in {id(value): value for value in values}.values():
+                value_code = Process.get_value_code(value, owner, seen)
+                if value_code:
+                    code += [name] + value_code
+        return code
+
+    @staticmethod
+    def get_value_code(value, owner, seen):
+        if isinstance(value, str) and value in ScaleFactor.tables:
+            return [value] + Process.get_table_code(ScaleFactor.tables[value])
+        elif isinstance(value, ScaleFactor):
+            return Process.get_table_code(value)
+        elif isinstance(value, np.ndarray):
+            return [value.tobytes()]
+        elif Process.is_constant(value):
+            return [repr(value)]
+        elif callable(value) and not inspect.isclass(value) and Process.is_local(value):
+            return Process.get_code(value, owner, seen)
+        return list()
+
+    @staticmethod
+    def get_function(func):
+        if hasattr(func, "_dispatcher"):
+            func = func._dispatcher
+        func = getattr(func, "py_func", func)
+        return getattr(func, "__func__", func)
+
+    @staticmethod
+    def get_names(code):
+        names = set(code.co_names)
+        for const in code.co_consts:
+            if inspect.iscode(const):
+                names |= Process.get_names(const)
+        return names
+
+    @staticmethod
+    def is_constant(value):
+        if isinstance(value, (list, tuple, set, frozenset)):
+            return all(Process.is_constant(item) for item in value)
+        elif isinstance(value, dict):
+            return all(Process.is_constant(key) and Process.is_constant(item)
+                       for key, item in value.items())
+        return value is None or isinstance(value, (bool, int, float, str, np.generic))
+
+    @staticmethod
+    def is_local(value):
+        # Defined in a module of this repo
+        if isinstance(value, FlatKernel):
+            return True
+        module = value if inspect.ismodule(value) else inspect.getmodule(
+            Process.get_function(value))
+        filename = getattr(module, "__file__", None)
+        return filename is not None and \
+            os.path.abspath(filename).startswith(Process.top_dir + os.sep)
+
+    def get_hashes(self):
+        return {job[1]: self.get_hash(job) for job in self.extraFuncs}
+
+    def get_all_vars(self, jobs=None):
         return_set = set()
-        for _, _, _, var_list, _ in self.extraFuncs:
+        for _, _, _, var_list, _ in self.extraFuncs if jobs is None else jobs:
             return_set |= set(var_list)
         return list(return_set)
     
+    def isScaleFactor(self, funcName):
+        return not hasattr(self, funcName) and funcName in ScaleFactor.tables
+
+    def isFlat(self, funcName):
+        return isinstance(getattr(self, funcName), FlatKernel)
+
     def isJit(self, funcName):
         return "Dispatcher" in repr(getattr(self, funcName))
 
     def isVectorize(self, funcName):
         return "DUFunc" in repr(getattr(self, funcName))
 
-    def get_masks(self, mask_name, start, end):
+    def get_node(self, mask_name):
+        # Masks made by a class built later start out as a bare node
+        if mask_name not in self.mask_tree:
+            self.mask_tree[mask_name] = Node(mask_name)
+        return self.mask_tree[mask_name]
+
+    def get_masks(self, mask_name, start=None, end=None):
         apply_list = list()
         node = self.mask_tree[mask_name]
         while node.name != "base":
@@ -109,8 +370,8 @@ class Process:
             node = node.parent
         return apply_list[::-1]
 
-    def add_var(self, mask_name, var_name, start, end):
-        variable = self.outmasks[var_name][start:end]
+    def add_var(self, mask_name, var_name, start, end, entries=None):
+        variable = self.get_column(var_name, start, end, entries)
         if mask_name is None:
             return variable
         var_parent = self.mask_tree[var_name].parent.name
@@ -121,6 +382,6 @@ class Process:
             apply_list.append(work_node.name)
             work_node = work_node.parent
             
-        for m_name in apply_list[::-1]:
-            variable = variable[self.outmasks[m_name][start:end]]
-        return variable
+        if len(apply_list) == 0:
+            return variable
+        return variable[self.get_selection(apply_list[::-1], start, end, entries)]
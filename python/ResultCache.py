@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+import os
+import glob
+import hashlib
+import awkward1 as ak
+import pyarrow
+import pyarrow.parquet
+import uproot4 as uproot
+from python.Process import Process
+
+# Job outputs of create stored on local disk under a key made from the input
+# file (path, size, mtime and ROOT uuid), the entry range, the job hash and
+# the keys of the jobs it reads, so a changed job also misses downstream.
+# Loading a result marks it used, past max_size the least recently used
+# results are removed.
+class ResultCache:
+    directory = None
+    max_size = 0
+    config_list = ["directory", "max_size"]
+
+    @staticmethod
+    def set_cache(directory, gigabytes=0):
+        ResultCache.directory = directory
+        ResultCache.max_size = int(gigabytes*1024**3)
+
+    @staticmethod
+    def get_input_key(filename, entry_start=None, entry_stop=None, extra=[]):
+        # One file, the files of a globbed sample are cached one by one
+        stat = os.stat(filename)
+        parts = [os.path.abspath(filename), stat.st_size, stat.st_mtime_ns,
+                 str(uproot.open(filename).file.uuid), entry_start, entry_stop]
+        return hashlib.sha1(repr(parts + list(extra)).encode()).hexdigest()
+
+    @staticmethod
+    def get_keys(graph, input_key):
+        keys = dict()
+        for name in graph.order:
+            process, job = graph.jobs[name]
+            parts = [input_key, process.get_hash(job)]
+            parts += sorted(keys[dep] for dep in graph.depends[name])
+            keys[name] = hashlib.sha1(repr(parts).encode()).hexdigest()
+        return keys
+
+    @staticmethod
+    def get_path(key):
+        return os.path.join(ResultCache.directory, key[:2], "{}.parquet".format(key))
+
+    @staticmethod
+    def has(key):
+        return os.path.isfile(ResultCache.get_path(key))
+
+    @staticmethod
+    def load(key):
+        path = ResultCache.get_path(key)
+        os.utime(path)
+        column = pyarrow.parquet.read_table(path).column("result")
+        array = ak.from_arrow(column)
+        return array if column.null_count > 0 else Process.drop_none(array)
+
+    @staticmethod
+    def store(key, array):
+        # Written under a temporary name, workers may share the cache
+        path = ResultCache.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        table = pyarrow.Table.from_arrays([ak.to_arrow(array)], names=["result"])
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        pyarrow.parquet.write_table(table, tmp_path, compression="gzip")
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def evict():
+        if ResultCache.max_size <= 0:
+            return
+        results = list()
+        for path in glob.glob(os.path.join(ResultCache.directory, "*", "*.parquet")):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            results.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in results)
+        for _, size, path in sorted(results):
+            if total <= ResultCache.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import awkward1 as ak
+import numpy as np
+
+# A binned table has one list of upper bin edges per axis. Bins are closed
+# on the right (x <= edge) unless closed is "left", values past the last
+# edge get overflow if it is given or the last bin otherwise.
+class ScaleFactor:
+    tables = dict()
+
+    def __init__(self, values, edges, absolute=None, closed="right",
+                 overflow=None, dtype="float64"):
+        self.values = np.asarray(values, dtype=dtype)
+        self.edges = [np.asarray(edge, dtype=np.float64) for edge in edges]
+        if [len(edge) for edge in self.edges] != list(self.values.shape):
+            raise ValueError("ScaleFactor: edges of length {} do not match values "
+                             "of shape {}".format([len(edge) for edge in self.edges],
+                                                  self.values.shape))
+        self.absolute = [False]*len(self.edges) if absolute is None else list(absolute)
+        self.side = "right" if closed == "left" else "left"
+        self.overflow = overflow
+
+    @staticmethod
+    def add_file(filename):
+        if filename.endswith(".json"):
+            with open(filename) as f:
+                for name, table in json.load(f).items():
+                    ScaleFactor.tables[name] = ScaleFactor(**table)
+        elif filename.endswith(".npz"):
+            arrays = np.load(filename)
+            name = os.path.splitext(os.path.basename(filename))[0]
+            table = {key: arrays[key].tolist() for key in arrays.files
+                     if not key.startswith("edges")}
+            table["edges"] = [arrays["edges{}".format(axis)]
+                              for axis in range(arrays["values"].ndim)]
+            ScaleFactor.tables[name] = ScaleFactor(**table)
+        else:
+            raise ValueError("ScaleFactor: can't read tables from {}".format(filename))
+
+    @staticmethod
+    def get_name(name, year):
+        table = "{}_{}".format(name, year)
+        if table not in ScaleFactor.tables:
+            raise ValueError("ScaleFactor: no table {} for {}".format(name, year))
+        return table
+
+    @staticmethod
+    def get_years():
+        # Years having every table, table names end in _<year>
+        names = dict()
+        for table in ScaleFactor.tables:
+            name, _, year = table.rpartition("_")
+            if year.isdigit():
+                names.setdefault(int(year), set()).add(name)
+        every = set().union(*names.values())
+        return sorted(year for year, found in names.items() if found == every)
+
+    def find_bin(self, axis, x):
+        if self.absolute[axis]:
+            x = np.abs(x)
+        return np.searchsorted(self.edges[axis], x, side=self.side)
+
+    def __call__(self, *columns):
+        offsets = None
+        if "var" in repr(ak.type(columns[0])):
+            counts = ak.to_numpy(ak.num(columns[0]))
+            offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+            np.cumsum(counts, out=offsets[1:])
+            columns = [ak.flatten(column) for column in columns]
+
+        bins = [self.find_bin(axis, ak.to_numpy(column))
+                for axis, column in enumerate(columns)]
+        over = np.zeros(len(bins[0]), dtype=bool)
+        for axis, idx in enumerate(bins):
+            over |= idx == len(self.edges[axis])
+            np.minimum(idx, len(self.edges[axis]) - 1, out=idx)
+        out = self.values[tuple(bins)]
+        if self.overflow is not None:
+            out[over] = self.overflow
+
+        layout = ak.layout.NumpyArray(out)
+        if offsets is not None:
+            layout = ak.layout.ListOffsetArray64(ak.layout.Index64(offsets), layout)
+        return ak.Array(layout)
@@ -2,54 +2,523 @@
 
 import python.Process as Process
 from python.CutApplier import CutApplier
+from python.StreamWriter import StreamWriter
+from python.Histogram import Histogram
+from python.MaskReader import MaskReader
+from python.MaskPacker import MaskPacker
+from python.Preskim import Preskim
+from python.JobGraph import JobGraph
+from python.EventReader import EventReader
+from python.ResultCache import ResultCache
+from python.ChunkBuffer import ChunkBuffer
+from concurrent.futures import ThreadPoolExecutor
 import awkward1 as ak
 import numpy as np
+import os
+import json
+import functools
+import pyarrow
+import pyarrow.parquet
 
 class Scheduler:
     jobs = list()
     write_list = list()
-    def __init__(self, group, files, out_dir, xsec):
+    fused = False
+    stream = False
+    job_threads = 1
+    prune = False
+    preskim = False
+    year = 2016
+    hists_only = False
+    incremental = False
+    pack_masks = False
+    config_list = ["jobs", "fused", "stream", "job_threads", "prune", "preskim",
+                   "year", "hists_only", "incremental", "pack_masks"]
+    def __init__(self, group, files, out_dir, xsec, shard=None):
 
-        self.process = Process()
+        self.process = Process(year=Scheduler.year)
         self.group = group
         self.files = files
         self.out_dir = out_dir
         self.xsec = xsec
+        self.shard = shard
+        self.hashes = dict()
+        self.levels = dict()
+        self.layout = None
+        self.packed = dict()
+        if shard is None:
+            self.name = group
+            self.entry_start, self.entry_stop, self.nevents = None, None, None
+        else:
+            self.name = "{}_shard{}".format(group, shard[0])
+            self.entry_start, self.entry_stop, self.nevents = shard[1:]
 
     @staticmethod
     def add_step(class_list):
         Scheduler.jobs.append(class_list)
 
-    def run(self):
-        print("{}: Starting Job".format(self.group))
+    @staticmethod
+    def get_shards(files, shard_size):
+        if shard_size <= 0 or not EventReader.is_single(files):
+            return [None]
+        nevents = EventReader.get_entries(files)
+        if nevents <= shard_size:
+            return [None]
+        return [(idx, start, min(start + shard_size, nevents), nevents)
+                for idx, start in enumerate(range(0, nevents, shard_size))]
+
+    @staticmethod
+    def merge_shards(group, out_dir, nshards, job_type):
+        suffixes = list()
+        if job_type in ["create", "all"]:
+            suffixes.append("")
+        if job_type in ["apply", "all"]:
+            suffixes += [Scheduler.get_cut_suffix(channel)
+                         for channel in CutApplier.get_channels()]
+        for suffix in suffixes:
+            if suffix == "" or not Scheduler.hists_only:
+                shards = ["{}/{}_shard{}{}.parquet".format(out_dir, group, idx, suffix)
+                          for idx in range(nshards)]
+                StreamWriter.merge(shards, "{}/{}{}.parquet".format(out_dir, group, suffix))
+                for shard in shards:
+                    os.remove(shard)
+            if suffix == "":
+                Scheduler.merge_hashes(group, out_dir, nshards)
+            else:
+                Scheduler.merge_cutflows(group, out_dir, nshards, suffix)
+                Scheduler.merge_entries(group, out_dir, nshards, suffix)
+                if len(CutApplier.hist_list) > 0:
+                    shards = ["{}/{}_shard{}{}_hists.npz".format(out_dir, group, idx, suffix)
+                              for idx in range(nshards)]
+                    Histogram.merge(shards, "{}/{}{}_hists.npz".format(out_dir, group, suffix))
+                    for shard in shards:
+                        os.remove(shard)
+        print("{}: Merged {} shards".format(group, nshards))
+
+    @staticmethod
+    def merge_cutflows(group, out_dir, nshards, suffix):
+        shards = ["{}/{}_shard{}{}flow.json".format(out_dir, group, idx, suffix)
+                  for idx in range(nshards)]
+        cutflows = list()
+        for shard in shards:
+            with open(shard) as f:
+                cutflows.append(json.load(f))
+        if any(cutflow["cuts"] != cutflows[0]["cuts"] for cutflow in cutflows):
+            print("{}: Cut order differs between shards, cutflows not merged"
+                  .format(group))
+            return
+        merged = {"cuts": cutflows[0]["cuts"],
+                  "events": np.sum([cutflow["events"] for cutflow in cutflows],
+                                   axis=0).tolist(),
+                  "weighted": np.sum([cutflow["weighted"] for cutflow in cutflows],
+                                     axis=0).tolist()}
+        with open("{}/{}{}flow.json".format(out_dir, group, suffix), "w") as f:
+            json.dump(merged, f, indent=4)
+        for shard in shards:
+            os.remove(shard)
+
+    @staticmethod
+    def merge_hashes(group, out_dir, nshards):
+        shards = ["{}/{}_shard{}_jobs.json".format(out_dir, group, idx)
+                  for idx in range(nshards)]
+        os.replace(shards[0], "{}/{}_jobs.json".format(out_dir, group))
+        for shard in shards[1:]:
+            os.remove(shard)
+
+    @staticmethod
+    def merge_entries(group, out_dir, nshards, suffix):
+        shards = ["{}/{}_shard{}{}entries.npy".format(out_dir, group, idx, suffix)
+                  for idx in range(nshards)]
+        entries = np.concatenate([np.load(shard) for shard in shards])
+        np.save("{}/{}{}entries.npy".format(out_dir, group, suffix), entries)
+        for shard in shards:
+            os.remove(shard)
+
+    @staticmethod
+    def get_cut_suffix(channel):
+        return "_cut" if channel is None else "_{}_cut".format(channel)
+
+    @staticmethod
+    def get_config():
+        # Class level registries, so worker processes can be set up the same
+        return {"Scheduler": {name: getattr(Scheduler, name)
+                              for name in Scheduler.config_list},
+                "CutApplier": {name: getattr(CutApplier, name)
+                               for name in CutApplier.config_list},
+                "EventReader": {name: getattr(EventReader, name)
+                                for name in EventReader.config_list},
+                "ResultCache": {name: getattr(ResultCache, name)
+                                for name in ResultCache.config_list}}
+
+    @staticmethod
+    def set_config(config):
+        for name, value in config["Scheduler"].items():
+            setattr(Scheduler, name, value)
+        for name, value in config["CutApplier"].items():
+            setattr(CutApplier, name, value)
+        for name, value in config["EventReader"].items():
+            setattr(EventReader, name, value)
+        for name, value in config["ResultCache"].items():
+            setattr(ResultCache, name, value)
+
+    @staticmethod
+    def set_fused(fused=True):
+        Scheduler.fused = fused
+
+    @staticmethod
+    def set_stream(stream=True):
+        Scheduler.stream = stream
+        if stream:
+            Scheduler.fused = True
+
+    @staticmethod
+    def set_year(year):
+        Scheduler.year = year
+        # A year without its scale factor tables fails here, not in a worker
+        process = Process(year=year)
         for job in Scheduler.jobs:
-            classes = [cls(self.process) for cls in job]
-            for cls in classes:
-                cls.run(self.files)
-                self.process += cls
-        print("{}: Finished Job".format(self.group))
+            for cls in job:
+                cls(process)
+
+    @staticmethod
+    def set_hists_only(hists_only=True):
+        Scheduler.hists_only = hists_only
+
+    @staticmethod
+    def set_incremental(incremental=True):
+        Scheduler.incremental = incremental
+        if incremental:
+            Scheduler.fused = True
+
+    @staticmethod
+    def set_pack_masks(pack_masks=True):
+        Scheduler.pack_masks = pack_masks
+        if pack_masks:
+            Scheduler.fused = True
+
+    @staticmethod
+    def set_job_threads(threads):
+        Scheduler.job_threads = threads
+
+    @staticmethod
+    def set_prune(prune=True):
+        Scheduler.prune = prune
+        if prune:
+            Scheduler.fused = True
+
+    @staticmethod
+    def set_preskim(preskim=True):
+        Scheduler.preskim = preskim
+        if preskim:
+            Scheduler.fused = True
+
+    def create(self):
+        if (Scheduler.incremental and
+                os.path.isfile("{}/{}.parquet".format(self.out_dir, self.group))):
+            self.update_tree()
+        elif Scheduler.stream:
+            self.stream_tree()
+        else:
+            self.run()
+            self.add_tree()
+
+    def run(self):
+        print("{}: Starting Job".format(self.name))
+        if Scheduler.fused:
+            self.run_fused()
+        else:
+            for job in Scheduler.jobs:
+                classes = [cls(self.process) for cls in job]
+                # One class at a time, as far as the masks of the others allow
+                for cls, jobs in JobGraph(classes).get_runs():
+                    cls.run(self.files, self.entry_start, self.entry_stop, jobs)
+                for cls in classes:
+                    self.process += cls
+                    self.hashes.update(cls.get_hashes())
+        print("{}: Finished Job".format(self.name))
+
+    def run_fused(self):
+        if (ResultCache.directory is None or Scheduler.preskim
+                or EventReader.is_single(self.files)):
+            for _ in self.iterate_fused():
+                pass
+            return
+        # Each file of the sample is cached on its own, so a changed file
+        # only reruns the jobs of that file
+        for filename in EventReader.get_files(self.files):
+            print("{}: Running {}".format(self.name, filename))
+            part = Scheduler(self.group, filename, self.out_dir, self.xsec)
+            part.run_fused()
+            for name, array in part.process.outmasks.items():
+                if name not in self.process.outmasks:
+                    self.process.outmasks[name] = ChunkBuffer()
+                self.process.outmasks[name].append(array.snapshot())
+            self.process.mask_tree.update(part.process.mask_tree)
+            self.hashes = part.hashes
+
+    def iterate_fused(self, stored=None):
+        # Every job of every step goes in one graph, so steps are no barrier
+        classes = [cls(self.process) for job in Scheduler.jobs for cls in job]
+        executor = None
+        if Scheduler.job_threads > 1:
+            executor = ThreadPoolExecutor(Scheduler.job_threads)
+        graph = JobGraph(classes, executor)
+        allvars = graph.get_all_vars()
+        if Scheduler.prune:
+            dropped = graph.prune(CutApplier.get_required())
+            unread = allvars - graph.get_all_vars()
+            allvars = graph.get_all_vars()
+            print("{}: Skipping jobs: {}".format(self.name, ", ".join(dropped)))
+            print("{}: Skipping branches: {}".format(self.name,
+                                                     ", ".join(sorted(unread))))
+        self.hashes = {name: process.get_hash(job)
+                       for name, (process, job) in graph.jobs.items()}
+        self.updated = list(graph.order)
+        cache_keys = None
+        # Masks are packed as each chunk is done when every job runs on it
+        packing = Scheduler.pack_masks and not Scheduler.stream and stored is None
+        if stored is not None:
+            # Stored outputs of unchanged jobs are kept, skims are not rerun
+            table, hashes = stored
+            stale = graph.get_stale(set(table.column_names), hashes)
+            graph.reuse(stale, lambda name: Scheduler.get_column(table, name))
+            allvars = graph.get_all_vars()
+            self.hashes = dict(hashes, **self.hashes)
+            self.updated = list(graph.order)
+            print("{}: Updating jobs: {}".format(self.name, ", ".join(self.updated)))
+            if len(stale) == 0:
+                return
+        elif Scheduler.preskim:
+            graph.set_skims(CutApplier.skim_list, CutApplier.sf_list)
+            self.levels = graph.get_levels()
+        elif ResultCache.directory is not None and not Scheduler.stream:
+            # Cached outputs are loaded, the rest is run and cached after
+            input_key = ResultCache.get_input_key(self.files, self.entry_start,
+                                                  self.entry_stop, [Scheduler.year])
+            cache_keys = ResultCache.get_keys(graph, input_key)
+            misses = {name for name, key in cache_keys.items()
+                      if not ResultCache.has(key)}
+            graph.reuse(misses, lambda name: ResultCache.load(cache_keys[name]),
+                        load_all=True)
+            allvars = graph.get_all_vars()
+            packing = packing and len(misses) == len(cache_keys)
+            print("{}: Cached jobs: {} of {}".format(self.name,
+                                                     len(cache_keys) - len(misses),
+                                                     len(cache_keys)))
+            if len(misses) == 0:
+                return
+
+        start, end = 0, 0
+        for array in EventReader.iterate(self.files, list(allvars),
+                                         self.entry_start, self.entry_stop,
+                                         list(graph.jobs)):
+            end += len(array)
+            print("Events considered: ", end)
+            graph.run_chunk(array, start, end)
+            if packing:
+                self.pack_chunk(start, end)
+            yield start, end
+            start = end
+        if executor is not None:
+            executor.shutdown()
+        for cls in classes:
+            self.process += cls
+        if cache_keys is not None:
+            for name in graph.order:
+                ResultCache.store(cache_keys[name], self.process.outmasks[name].snapshot())
+            ResultCache.evict()
+
+        if Scheduler.preskim:
+            print("{}: Preskim kept {} of {} events".format(self.name, graph.events[1],
+                                                           graph.events[0]))
+        path_time, path = graph.critical_path()
+        print("{}: Critical path {:.2f}s of {:.2f}s job time: {}".format(
+            self.name, path_time, sum(graph.timing.values()), " -> ".join(path)))
+
+    def update_tree(self):
+        print("{}: Starting Update".format(self.name))
+        filename = "{}/{}.parquet".format(self.out_dir, self.group)
+        table = MaskPacker.unpack_table(pyarrow.parquet.read_table(filename))
+        if self.shard is not None:
+            table = table.slice(self.entry_start, self.entry_stop - self.entry_start)
+        hashes = Scheduler.read_hashes("{}/{}_jobs.json".format(self.out_dir, self.group))
+        if Preskim.column in table.column_names:
+            # Skimmed events have no masks to reuse, every job runs again
+            print("{}: Mask file was made with --preskim, remaking all masks"
+                  .format(self.name))
+            table, hashes = table.select([Preskim.column]), dict()
+        for _ in self.iterate_fused((table, hashes)):
+            pass
+
+        if len(self.updated) == 0 and self.shard is None:
+            print("{}: Masks are up to date".format(self.name))
+            self.write_hashes()
+            return
+        for name in self.updated:
+            column = ak.to_arrow(self.process.outmasks[name].snapshot())
+            if name in table.column_names:
+                table = table.set_column(table.column_names.index(name), name, column)
+            else:
+                table = table.append_column(name, column)
+        if Preskim.column in table.column_names:
+            table = table.remove_column(table.column_names.index(Preskim.column))
+        if Scheduler.pack_masks:
+            columns = {name: ak.from_arrow(table.column(name))
+                       for name in table.column_names}
+            layout = MaskPacker.get_layout(columns, self.process.mask_tree)
+            table = MaskPacker.to_table(MaskPacker.pack(columns, layout), layout)
+        pyarrow.parquet.write_table(table, "{}/{}.parquet".format(self.out_dir, self.name),
+                                    compression="gzip")
+        self.write_hashes()
+        print("{}: Finished Update".format(self.name))
+
+    @staticmethod
+    def get_column(table, name):
+        column = table.column(name)
+        array = ak.from_arrow(column)
+        # Option types come from the file, only skimmed events are None
+        return array if column.null_count > 0 else Process.drop_none(array)
+
+    @staticmethod
+    def read_hashes(filename):
+        if not os.path.isfile(filename):
+            return dict()
+        with open(filename) as f:
+            return json.load(f)
+
+    def write_hashes(self):
+        with open("{}/{}_jobs.json".format(self.out_dir, self.name), "w") as f:
+            json.dump(self.hashes, f, indent=4, sort_keys=True)
+
+    def stream_tree(self):
+        print("{}: Starting Job".format(self.name))
+        writer = StreamWriter("{}/{}.parquet".format(self.out_dir, self.name))
+        layout = None
+        for start, end in self.iterate_fused():
+            columns = {key: arr[start:end] for key, arr in self.process.outmasks.items()}
+            if Scheduler.pack_masks or Scheduler.preskim:
+                if layout is None:
+                    layout = self.get_layout(columns)
+                writer.write_table(self.get_table(columns, layout))
+            else:
+                writer.write(columns)
+            for arr in self.process.outmasks.values():
+                arr.clear()
+        writer.close()
+        self.write_hashes()
+        print("{}: Finished Job".format(self.name))
 
-        
     def add_tree(self):
-        print("{}: Starting Write".format(self.group))
-        total_mask = ak.Array({})
-        for key, arr in self.process.outmasks.items():
-            total_mask[key] = arr
-        ak.to_parquet(total_mask, "{}/{}.parquet".format(self.out_dir, self.group),
-                      compression="gzip")
-        print("{}: Finished Write".format(self.group))
+        print("{}: Starting Write".format(self.name))
+        filename = "{}/{}.parquet".format(self.out_dir, self.name)
+        if Scheduler.pack_masks or Scheduler.preskim:
+            # Masks packed in memory are written as they are
+            packed = {name for masks in (self.layout or dict()).values()
+                      for name, _, _ in masks}
+            columns = {key: arr.snapshot() for key, arr in self.process.outmasks.items()
+                       if key not in packed}
+            columns.update({key: arr.snapshot() for key, arr in self.packed.items()})
+            layout = self.layout if self.layout is not None else self.get_layout(columns)
+            table = self.get_table(columns, layout)
+            pyarrow.parquet.write_table(table, filename, compression="gzip")
+        else:
+            total_mask = ak.Array({})
+            for key, arr in self.process.outmasks.items():
+                total_mask[key] = arr.snapshot()
+            ak.to_parquet(total_mask, filename, compression="gzip")
+        self.write_hashes()
+        print("{}: Finished Write".format(self.name))
+
+    def pack_chunk(self, start, end):
+        # The masks of a done chunk are kept as one integer per object, and
+        # only unpacked when read
+        outmasks = self.process.outmasks
+        if self.layout is None:
+            self.layout = self.get_layout({name: arr[start:end]
+                                           for name, arr in outmasks.items()})
+            self.packed = {packed: ChunkBuffer() for packed in self.layout}
+        for packed, masks in self.layout.items():
+            columns = {name: outmasks[name][start:end] for name, _, _ in masks}
+            array = MaskPacker.pack(columns, {packed: masks})[packed]
+            self.packed[packed].append(array)
+            for name, _, _ in masks:
+                outmasks[name].set_last(functools.partial(MaskPacker.unpack_mask,
+                                                          array, masks, name))
+
+    def get_layout(self, columns):
+        if not Scheduler.pack_masks:
+            return dict()
+        return MaskPacker.get_layout(columns, self.process.mask_tree)
+
+    def get_table(self, columns, layout):
+        # Packing keeps the Nones of skimmed events, they are filled after
+        columns = MaskPacker.pack(columns, {packed: masks for packed, masks in layout.items()
+                                            if packed not in columns})
+        if not Scheduler.preskim:
+            return MaskPacker.to_table(columns, layout)
+        levels = Preskim.get_levels(self.levels, layout)
+        table = MaskPacker.to_table(Preskim.fill(columns, levels), layout)
+        return Preskim.set_levels(table, levels)
+
+    def get_mask(self):
+        # A shard made in this job has its own file, else use its slice
+        columns = CutApplier.get_required()
+        filename = "{}/{}.parquet".format(self.out_dir, self.name)
+        if self.shard is None or os.path.isfile(filename):
+            return MaskReader(filename, columns)
+        filename = "{}/{}.parquet".format(self.out_dir, self.group)
+        return MaskReader(filename, columns, self.entry_start, self.entry_stop)
 
     def apply_mask(self):
-        print("{}: Starting Apply".format(self.group))
-        cut_apply = CutApplier(ak.from_parquet(
-            "{}/{}.parquet".format(self.out_dir, self.group)), self.xsec)
-        cut_apply.run(self.files)
-        print("{}: Finished Apply".format(self.group))
+        print("{}: Starting Apply".format(self.name))
+        cut_apply = CutApplier(self.get_mask(), self.xsec, self.nevents)
+        filenames = {channel: "{}/{}{}.parquet".format(self.out_dir, self.name,
+                                                       Scheduler.get_cut_suffix(channel))
+                     for channel in CutApplier.get_channels()}
+        if Scheduler.hists_only:
+            for _ in cut_apply.iterate(self.files, self.entry_start, self.entry_stop):
+                pass
+            print("{}: Finished Apply".format(self.name))
+            self.write_summary(cut_apply, filenames)
+            return
+        elif Scheduler.stream:
+            writers = {channel: StreamWriter(filename)
+                       for channel, filename in filenames.items()}
+            for outputs in cut_apply.iterate(self.files, self.entry_start,
+                                             self.entry_stop):
+                for channel, output in outputs.items():
+                    writers[channel].write(output)
+            for writer in writers.values():
+                writer.close()
+            print("{}: Finished Apply".format(self.name))
+            self.write_summary(cut_apply, filenames)
+            return
+
+        cut_apply.run(self.files, self.entry_start, self.entry_stop)
+        print("{}: Finished Apply".format(self.name))
+        self.write_summary(cut_apply, filenames)
         # write
-        print("{}: Starting Write".format(self.group))
-        total_mask = ak.Array({})
-        for key, arr in cut_apply.output.items():
-            total_mask[key] = arr
-        ak.to_parquet(total_mask, "{}/{}_cut.parquet".format(self.out_dir, self.group),
-                      compression="gzip")
-        print("{}: Finished Write".format(self.group))
+        print("{}: Starting Write".format(self.name))
+        for channel, output in cut_apply.output.items():
+            # Written like the streamed outputs, so a shard selecting no
+            # objects still gets a file its group can merge
+            writer = StreamWriter(filenames[channel])
+            writer.write({key: arr.snapshot() for key, arr in output.items()})
+            writer.close()
+        print("{}: Finished Write".format(self.name))
+
+    def write_summary(self, cut_apply, filenames):
+        # Cutflows, passing entries and histograms are complete once every
+        # chunk is applied
+        for channel, cutflow in cut_apply.cutflow.items():
+            cuts, events, weighted = zip(*cutflow)
+            with open(filenames[channel][:-len(".parquet")] + "flow.json", "w") as f:
+                json.dump({"cuts": cuts, "events": events, "weighted": weighted},
+                          f, indent=4)
+        for channel, entries in cut_apply.entries.items():
+            np.save(filenames[channel][:-len(".parquet")] + "entries.npy",
+                    np.concatenate([np.zeros(0, dtype=np.int64)] + entries))
+        if len(CutApplier.hist_list) == 0:
+            return
+        for channel, hists in cut_apply.hists.items():
+            Histogram.write(hists, filenames[channel][:-len(".parquet")] + "_hists.npz")
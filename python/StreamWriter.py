@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import awkward1 as ak
+import pyarrow
+import pyarrow.parquet
+
+class StreamWriter:
+    def __init__(self, filename, compression="gzip"):
+        self.filename = filename
+        self.compression = compression
+        self.writer = None
+        self.pending = list()
+
+    def write(self, columns):
+        names = list(columns.keys())
+        arrays = [ak.to_arrow(columns[name]) for name in names]
+        self.write_table(pyarrow.Table.from_arrays(arrays, names=names))
+
+    def write_table(self, table):
+        # A chunk with no values in a column comes out untyped. The file
+        # takes the schema of the first chunk typed throughout, the chunks
+        # before it are cast to it
+        if self.writer is None:
+            self.pending.append(table)
+            if all(StreamWriter.is_typed(field.type) for field in table.schema):
+                self.open(table.schema)
+            return
+        self.writer.write_table(self.cast(table))
+
+    def open(self, schema):
+        self.writer = pyarrow.parquet.ParquetWriter(
+            self.filename, schema, compression=self.compression)
+        for table in self.pending:
+            self.writer.write_table(self.cast(table))
+        self.pending = list()
+
+    def cast(self, table):
+        if table.schema.equals(self.writer.schema):
+            return table
+        return table.cast(self.writer.schema)
+
+    def close(self):
+        if self.writer is None and len(self.pending) > 0:
+            # No chunk had values in every column, those stay null
+            self.open(StreamWriter.get_schema(self.pending[-1].schema))
+        if self.writer is not None:
+            self.writer.close()
+
+    @staticmethod
+    def is_typed(datatype):
+        if pyarrow.types.is_null(datatype):
+            return False
+        return all(StreamWriter.is_typed(datatype.field(idx).type)
+                   for idx in range(datatype.num_fields))
+
+    @staticmethod
+    def get_schema(schema):
+        # Parquet only takes null type fields that are nullable
+        fields = [StreamWriter.get_field(field) for field in schema]
+        return pyarrow.schema(fields, metadata=schema.metadata)
+
+    @staticmethod
+    def get_field(field):
+        datatype = field.type
+        if pyarrow.types.is_null(datatype):
+            return field.with_nullable(True)
+        elif pyarrow.types.is_large_list(datatype):
+            datatype = pyarrow.large_list(StreamWriter.get_field(datatype.value_field))
+        elif pyarrow.types.is_fixed_size_list(datatype):
+            datatype = pyarrow.list_(StreamWriter.get_field(datatype.value_field),
+                                     datatype.list_size)
+        elif pyarrow.types.is_list(datatype):
+            datatype = pyarrow.list_(StreamWriter.get_field(datatype.value_field))
+        elif pyarrow.types.is_struct(datatype):
+            datatype = pyarrow.struct([StreamWriter.get_field(datatype[idx])
+                                       for idx in range(datatype.num_fields)])
+        return field.with_type(datatype)
+
+    @staticmethod
+    def merge(filenames, output, compression="gzip"):
+        writer = StreamWriter(output, compression)
+        for filename in filenames:
+            infile = pyarrow.parquet.ParquetFile(filename)
+            for group in range(infile.num_row_groups):
+                writer.write_table(infile.read_row_group(group))
+        writer.close()
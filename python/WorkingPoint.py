@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+import math
+import numpy as np
+from python.FlatKernel import FlatKernel
+
+# Cut on a discriminant that depends on pt and |eta|. Nothing passes below
+# pt_edges[0] or past the last eta edge. Between two pt edges the cut goes
+# linearly from start to end, past the last one it stays at start. Rows of
+# start and end are pt bins, columns are eta bins with |eta| < edge.
+#
+# The tables are frozen into the compiled kernel, which takes the flat pt,
+# eCorr, eta and discriminant of every object.
+class WorkingPoint(FlatKernel):
+    def __init__(self, like, pt_edges, start, end, eta_edges, use_atanh=False):
+        pt_edges = np.asarray(pt_edges, dtype=np.float64)
+        start = np.asarray(start, dtype=np.float64)
+        end = np.asarray(end, dtype=np.float64)
+        eta_edges = np.asarray(eta_edges, dtype=np.float64)
+        if start.shape != (len(pt_edges), len(eta_edges)) or start.shape != end.shape:
+            raise ValueError("WorkingPoint: tables of shape {} and {} do not match "
+                             "{} pt and {} eta edges".format(start.shape, end.shape,
+                                                             len(pt_edges), len(eta_edges)))
+        last = len(pt_edges) - 1
+
+        def kernel(pt, eCorr, eta, mva, offsets, out):
+            for i in range(len(pt)):
+                pt_cor = pt[i]/eCorr[i]
+                abs_eta = abs(eta[i])
+                if pt_cor < pt_edges[0] or abs_eta >= eta_edges[-1]:
+                    continue
+                ptbin = np.searchsorted(pt_edges, pt_cor, side="right") - 1
+                etabin = np.searchsorted(eta_edges, abs_eta, side="right")
+                cut = start[ptbin, etabin]
+                if ptbin < last:
+                    cut += ((end[ptbin, etabin] - cut) * (pt_cor - pt_edges[ptbin])
+                            / (pt_edges[ptbin+1] - pt_edges[ptbin]))
+                if use_atanh:
+                    out[i] = math.atanh(mva[i]) > cut
+                else:
+                    out[i] = mva[i] > cut
+
+        super().__init__(kernel, np.bool_, like)
@@ -2,3 +2,9 @@
 
 from .Process import Process
 from .Scheduler import Scheduler
+from .ChunkBuffer import ChunkBuffer
+from .JobGraph import JobGraph
+from .FlatKernel import FlatKernel
+from .ScaleFactor import ScaleFactor
+from .PairEngine import PairEngine
+from .Histogram import Histogram
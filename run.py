@@ -2,61 +2,109 @@
 
 from python.Scheduler import Scheduler
 from python.CutApplier import CutApplier
-from modules import set_channel
+from python.EventReader import EventReader
+from python.ResultCache import ResultCache
+from python.ScaleFactor import ScaleFactor
+from modules import set_channel, set_channels, channels
 from threading import Thread
 from queue import Queue
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import Utilities.FileGetter as fg
 from Utilities.FileGetter import pre
 
 import warnings
 import os
+import traceback
 warnings.filterwarnings('ignore')
 
 def job_run(job_type, *args):
     job = Scheduler(*args)
     if job_type == "create":
-        job.run()
-        job.add_tree()
+        job.create()
     elif job_type == "apply":
         job.apply_mask()
     elif job_type == "all":
-        job.run()
-        job.add_tree()
+        job.create()
         job.apply_mask()
     else:
         print("problem with job")
 
 
+def init_worker(config):
+    warnings.filterwarnings('ignore')
+    Scheduler.set_config(config)
+
+
 def worker():
     while True:
-        job_type, group, files, outdir, xsec = q.get()
-        job_run(job_type, group, files, outdir, xsec)
+        job_run(*q.get())
         q.task_done()
 
 
 if __name__ == "__main__":
-    args = fg.get_generic_args()
+    # Only years with scale factor tables can be run
+    args = fg.get_generic_args(ScaleFactor.get_years())
 
-    if args.channel:
-        set_channel(args.channel)
+    if args.channel == ["all"]:
+        args.channel = channels
+    if len(args.channel) == 1:
+        set_channel(args.channel[0])
+    elif len(args.channel) > 1:
+        set_channels(args.channel)
+    CutApplier.set_reorder(args.reorder_cuts)
+    Scheduler.set_year(args.year)
+    Scheduler.set_hists_only(args.hists_only)
+    EventReader.set_prefetch(args.prefetch)
+    EventReader.set_memory_budget(args.memory_budget)
+    Scheduler.set_fused(args.fused)
+    Scheduler.set_stream(args.stream)
+    Scheduler.set_job_threads(args.job_threads)
+    Scheduler.set_prune(args.prune)
+    Scheduler.set_pack_masks(args.pack_masks)
+    Scheduler.set_preskim(args.preskim)
+    Scheduler.set_incremental(args.incremental)
+    if args.cache_dir is not None:
+        ResultCache.set_cache(args.cache_dir, args.cache_size)
+        Scheduler.set_fused(True)
     info = fg.FileGetter(args.analysis, args.selection)
     files_dict = info.get_file_dict(args.filenames)
     fg.checkOrCreateDir(args.outdir)
 
     argList = list()
+    sharded = dict()
     for group, files in files_dict.items():
         mask_exists = os.path.isfile("{}/{}.parquet".format(args.outdir, group))
         if args.proc_type == "apply" and not mask_exists:
             print("Mask file doesn't exist, please create!")
             exit(1)
-        elif args.proc_type == "create" and not args.r and mask_exists:
+        elif (args.proc_type == "create" and not args.r and not args.incremental
+              and mask_exists):
             continue
-        argList.append((args.proc_type, group, files, args.outdir,
-                        info.get_xsec(group)))
+        shards = Scheduler.get_shards(files, args.shard_size)
+        if len(shards) > 1:
+            sharded[group] = len(shards)
+        for shard in shards:
+            argList.append((args.proc_type, group, files, args.outdir,
+                            info.get_xsec(group), shard))
 
     if args.j == 1:
         for arg in argList:
             job_run(arg[0], *arg[1:])
+    elif args.backend == "process":
+        failed = list()
+        with ProcessPoolExecutor(args.j, initializer=init_worker,
+                                 initargs=(Scheduler.get_config(),)) as pool:
+            futures = {pool.submit(job_run, *arg): arg[1] for arg in argList}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception:
+                    print("{}: Job failed".format(futures[future]))
+                    traceback.print_exc()
+                    failed.append(futures[future])
+        if failed:
+            print("Failed groups: {}".format(", ".join(sorted(set(failed)))))
+            exit(1)
     else:
         q = Queue()
         for _ in range(args.j):
@@ -68,4 +116,7 @@ if __name__ == "__main__":
 
         q.join()       # block until all tasks are done
 
+    for group, nshards in sharded.items():
+        Scheduler.merge_shards(group, args.outdir, nshards, args.proc_type)
+
 
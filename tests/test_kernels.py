@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+# Run from the top directory: python -m pytest tests
+# Checks the ported jobs give the same outputs as the versions they
+# replaced, on the same random events.
+
+import math
+import numba
+import numpy as np
+import awkward1 as ak
+import pytest
+
+from benchmarks import kernels
+from python.ScaleFactor import ScaleFactor
+from python.FlatKernel import flat_kernel
+from modules import Electron, EventWide
+from Utilities.FileGetter import pre
+
+@pytest.fixture(scope="module")
+def events():
+    np.random.seed(5)
+    return kernels.make_events(2000)
+
+# calc_event_shape gives the eigenvalues, not the sphericity the old job gave
+flat_kernels = [name for name in kernels.kernels if name != "calc_event_shape"]
+
+@pytest.mark.parametrize("name", flat_kernels)
+def test_flat_kernel(events, name):
+    builder_kernel, flat_kernel, vals, addvals = kernels.kernels[name]
+    expected = kernels.run_builder(builder_kernel, events, vals, addvals)
+    found = kernels.run_flat(flat_kernel, events, vals, addvals)
+    assert ak.to_list(found) == ak.to_list(expected)
+
+# Scale factor lookups as they were before the ScaleFactor tables
+@numba.vectorize('f4(f4,f4,f4)')
+def lep_lowHT_sf(pt, eCorr, eta):
+    pt_cor = pt/eCorr
+    sf = np.array([[0.9149, 0.9768, 1.0781, 0.9169, 1.1100],
+                   [0.9170, 0.9497, 0.9687, 0.9356, 0.9894 ],
+                   [0.9208, 0.9483, 0.9923, 0.9438, 0.9781],
+                   [0.9202, 0.9514, 0.9827, 0.9480, 0.9627],
+                   [0.9207, 0.9481, 0.9848, 0.9480, 0.9477],
+                   [0.9472, 0.9333, 0.9934, 0.9383, 0.9597]])
+    pt_edges = np.array([20, 30, 40, 50, 100, 14000])
+    eta_edges = np.array([0.8, 1.442, 1.566, 2., 2.5])
+    return sf[np.argmax(pt_cor <= pt_edges), np.argmax(abs(eta) <= eta_edges)]
+
+@numba.vectorize('f4(f4,f4,f4)')
+def lep_highHT_sf(pt, eCorr, eta):
+    pt_cor = pt/eCorr
+    sf = np.array([[0.9158, 0.9820, 1.0756, 0.9203, 1.1124],
+                   [0.9177, 0.9499, 0.9710, 0.9370, 0.9904],
+                   [0.9210, 0.9472, 0.9927, 0.9443, 0.9785],
+                   [0.9213, 0.9515, 0.9830, 0.9480, 0.9628],
+                   [0.9212, 0.9483, 0.9845, 0.9480, 0.9483],
+                   [0.9469, 0.9429, 0.9932, 0.9455, 0.9592]])
+    pt_edges = np.array([20, 30, 40, 50, 100, 14000])
+    eta_edges = np.array([0.8, 1.442, 1.566, 2., 2.5])
+    return sf[np.argmax(pt_cor <= pt_edges), np.argmax(abs(eta) <= eta_edges)]
+
+@numba.vectorize('f4(f4)')
+def lep_GSF_sf(eta):
+    sf = np.array([1.1703, 1.0085, 1.0105, 1.0052, 0.9979, 0.9917, 0.9865,
+                   0.9616, 0.9867, 0.9775, 0.9694, 0.9664, 0.9633, 0.9600,
+                   0.9662, 0.9796, 0.9766, 0.9807, 0.9867, 0.9867, 0.9707,
+                   0.9897, 0.9959, 0.9897, 0.9949, 0.9928, 0.9666, 0.8840])
+    eta_edges = np.array([-2.4, -2.3, -2.2, -2.0, -1.8, -1.63, -1.566,
+                          -1.444, -1.2, -1.0, -0.6, -0.4, -0.2, 0.0, 0.2,
+                          0.4, 0.6, 1.0, 1.2, 1.444, 1.566, 1.63, 1.8, 2.0,
+                          2.2, 2.3, 2.4, 2.5])
+    return sf[np.argmax(eta <= eta_edges)]
+
+@numba.vectorize('f4(f4,f4)')
+def muon_sf(pt, eta):
+    sf = np.array([[0.9047, 0.8860, 0.8916, 0.8394],
+                   [0.9430, 0.9685, 0.9741, 0.8917],
+                   [0.9707, 0.9724, 0.9777, 0.9180],
+                   [0.9821, 0.9850, 0.9934, 0.9389],
+                   [0.9854, 0.9861, 0.9968, 0.9453],
+                   [0.9813, 0.9819, 0.9964, 0.9410],
+                   [0.9830, 0.9861, 0.9994, 0.9525]])
+    pt_edges = np.array([20, 25, 30, 40, 50, 60, 14000])
+    eta_edges = np.array([0.9, 1.2, 2.1, 2.4])
+    return sf[np.argmax(pt <= pt_edges), np.argmax(abs(eta) <= eta_edges)]
+
+@numba.vectorize('f4(f4)')
+def lep_tracking_sf(eta):
+    sf = np.array([0.9879, 0.9939, 0.9970, 0.9954, 0.9937, 0.9959, 0.9976,
+                   0.9961, 0.9930, 0.9819])
+    eta_edges = np.array([-2.1, -1.6, -1.1, -0.6, 0.0, 0.6, 1.1, 1.6,
+                          2.1, 2.4])
+    return sf[np.argmax(eta <= eta_edges)]
+
+@numba.vectorize('f8(f8)', nopython=True)
+def pileup_scale(pileup):
+    pileupScales = [
+        0.366077, 0.893925, 1.197716, 0.962699, 1.120976, 1.164859, 0.795599, 0.495824,
+        0.742182, 0.878856, 0.964232, 1.072499, 1.125335, 1.176027, 1.202083, 1.207643,
+        1.200176, 1.182682, 1.143998, 1.096632, 1.065602, 1.051166, 1.051600, 1.050630,
+        1.049862, 1.058173, 1.072155, 1.083030, 1.095693, 1.107871, 1.094621, 1.082620,
+        1.041247, 0.985752, 0.910807, 0.820923, 0.716787, 0.610013, 0.503118, 0.404841,
+        0.309195, 0.227920, 0.163690, 0.113180, 0.077300, 0.050922, 0.031894, 0.020094,
+        0.012263, 0.007426, 0.004380, 0.002608, 0.001566, 0.000971, 0.000729, 0.000673,
+        0.000730, 0.000949, 0.001355, 0.001894, 0.003082, 0.004097, 0.004874, 0.005256,
+        0.005785, 0.005515, 0.005000, 0.004410, 0.004012, 0.003548, 0.003108, 0.002702,
+        0.002337, 0.002025, 0.001723, ]
+    if int(pileup) > len(pileupScales):
+        return 0.
+    else:
+        return pileupScales[int(pileup)]
+
+def uniform(counts, low, high, dtype=np.float32):
+    return kernels.jagged(counts, np.random.uniform(low, high, counts.sum()).astype(dtype))
+
+# Inputs stay inside the old tables, past them the old lookups gave bin 0
+def test_scale_factors():
+    np.random.seed(11)
+    counts = np.random.randint(0, 4, 2000)
+    pt, eCorr = uniform(counts, 10, 500), uniform(counts, 0.9, 1.1)
+    eta, muon_eta = uniform(counts, -2.5, 2.5), uniform(counts, -2.4, 2.4)
+    pt_cor = pt/eCorr
+    checks = [("Electron_lowHTSF_2016", [pt_cor, eta], lep_lowHT_sf(pt, eCorr, eta)),
+              ("Electron_highHTSF_2016", [pt_cor, eta], lep_highHT_sf(pt, eCorr, eta)),
+              ("Electron_gsfSF_2016", [eta], lep_GSF_sf(eta)),
+              ("Muon_idSF_2016", [pt, muon_eta], muon_sf(pt, muon_eta)),
+              ("Muon_trackingSF_2016", [muon_eta], lep_tracking_sf(muon_eta))]
+    for name, columns, expected in checks:
+        found = ScaleFactor.tables[name](*columns)
+        assert ak.to_list(ak.num(found)) == ak.to_list(counts), name
+        assert np.array_equal(ak.to_numpy(ak.flatten(found)),
+                              ak.to_numpy(ak.flatten(expected))), name
+
+    pileup = np.random.uniform(0, 75, 2000)
+    assert np.array_equal(ak.to_numpy(ScaleFactor.tables["pileup_2016"](ak.Array(pileup))),
+                          pileup_scale(pileup))
+
+# Electron MVA working points as they were before WorkingPoint
+@numba.vectorize('b1(f4,f4,f4,f4)',nopython=True)
+def mva_loose_2016(pt, eCorr, eta, mva):
+    A = np.array([-0.48, -0.67, -0.49])
+    B = np.array([-0.85, -0.91, -0.83])
+    C = (B-A)/10
+    if pt/eCorr < 5: return False
+    elif pt/eCorr < 10:  mvaVec = np.array([-0.46, -0.03, 0.06])
+    elif pt/eCorr < 15:  mvaVec = A
+    elif pt/eCorr < 25:  mvaVec = A + C*(pt/eCorr-15)
+    else:                mvaVec = B
+
+    if abs(eta) < 0.8:     mvaCut = mvaVec[0]
+    elif abs(eta) < 1.479: mvaCut = mvaVec[1]
+    elif abs(eta) < 2.5:   mvaCut = mvaVec[2]
+
+    return mva > mvaCut
+
+@numba.vectorize('b1(f4,f4,f4,f4)',nopython=True)
+def mva_tight_2016(pt, eCorr, eta, mva):
+    A = np.array([0.77, 0.56, 0.48])
+    B = np.array([0.52, 0.11, -0.01])
+    C = (B-A)/10
+    if pt/eCorr < 10: return False
+    elif pt/eCorr < 15:  mvaVec = A
+    elif pt/eCorr < 25:  mvaVec = A + C*(pt/eCorr-15)
+    else:                mvaVec = B
+
+    if abs(eta) < 0.8:     mvaCut = mvaVec[0]
+    elif abs(eta) < 1.479: mvaCut = mvaVec[1]
+    elif abs(eta) < 2.5:   mvaCut = mvaVec[2]
+
+    return mva > mvaCut
+
+@numba.vectorize('b1(f4,f4,f4,f4)')
+def mva_loose_2017(pt, eCorr, eta, mva):
+    A = np.array([0.488, -0.045, 0.176])
+    B = np.array([-0.64, -0.775, -0.733])
+    C = np.array([0.148, 0.075, 0.077])
+    if pt/eCorr < 5: return False
+    elif pt/eCorr < 10:  mvaVec = A
+    elif pt/eCorr < 25:  mvaVec = B - C*(1 - (pt/eCorr-10)/15)
+    else:                mvaVec = B
+
+    if abs(eta) < 0.8:     mvaCut = mvaVec[0]
+    elif abs(eta) < 1.479: mvaCut = mvaVec[1]
+    elif abs(eta) < 2.5:   mvaCut = mvaVec[2]
+
+    return mva > mvaCut
+
+@numba.vectorize('b1(f4,f4,f4,f4)')
+def mva_tight_2017(pt, eCorr, eta, mva):
+    B = np.array([0.68, 0.475, 0.32])
+    C = np.array([0.48 , 0.375, 0.42])
+    if pt/eCorr < 10: return False
+    elif pt/eCorr < 25:  mvaVec = B - C*(1 - (pt/eCorr-10)/15)
+    else:                mvaVec = B
+
+    if abs(eta) < 0.8:     mvaCut = mvaVec[0]
+    elif abs(eta) < 1.479: mvaCut = mvaVec[1]
+    elif abs(eta) < 2.5:   mvaCut = mvaVec[2]
+
+    return mva > mvaCut
+
+@numba.vectorize('b1(f4,f4,f4,f4)')
+def mva_loose_2018(pt, eCorr, eta, mva):
+    A = np.array([1.32, 0.192, 0.363])
+    B = np.array([1.204, 0.084, -0.123])
+    C = np.array([0.066, 0.033, 0.053])
+    if pt < 5: return False
+
+    elif pt/eCorr < 10:  mvaVec = A
+    elif pt/eCorr < 25:  mvaVec = B + C*(pt/eCorr-25)
+    else:                mvaVec = B
+
+    if abs(eta) < 0.8:     mvaCut = mvaVec[0]
+    elif abs(eta) < 1.479: mvaCut = mvaVec[1]
+    elif abs(eta) < 2.5:   mvaCut = mvaVec[2]
+
+    return math.atanh(mva) > mvaCut
+
+@numba.vectorize('b1(f4,f4,f4,f4)')
+def mva_tight_2018(pt, eCorr, eta, mva):
+    B = np.array([4.277, 3.152, 2.359])
+    C = np.array([0.112, 0.06, 0.087])
+    if pt/eCorr < 10: return False
+    elif pt/eCorr < 25:  mvaVec = B + C*(pt/eCorr-25)
+    else:                mvaVec = B
+
+    if abs(eta) < 0.8:     mvaCut = mvaVec[0]
+    elif abs(eta) < 1.479: mvaCut = mvaVec[1]
+    elif abs(eta) < 2.5:   mvaCut = mvaVec[2]
+
+    return math.atanh(mva) > mvaCut
+
+mva_functions = {2016: (mva_loose_2016, mva_tight_2016),
+                 2017: (mva_loose_2017, mva_tight_2017),
+                 2018: (mva_loose_2018, mva_tight_2018)}
+
+# pt and pt/eCorr are both above 5 GeV, where the old 2018 loose point cut
+# on pt, and |eta| stays below 2.5, where the old cuts were undefined
+@pytest.mark.parametrize("year", list(mva_functions))
+def test_working_point(year):
+    np.random.seed(year)
+    counts = np.random.randint(0, 4, 2000)
+    branch, loose, tight = Electron.mva_wp[year]
+    events = {"Electron_pt": uniform(counts, 6, 60), "Electron_eCorr": uniform(counts, 0.9, 1.1),
+              "Electron_eta": uniform(counts, -2.49, 2.49), branch: uniform(counts, -1, 1),
+              "genWeight": ak.Array(np.ones(len(counts), dtype=np.float32))}
+    columns = [events[col] for col in Electron.mva + [branch]]
+    for working_point, function in zip([loose, tight], mva_functions[year]):
+        found = kernels.run_flat(working_point, events, Electron.mva + [branch], [])
+        assert ak.to_list(found) == ak.to_list(function(*columns))
+
+# Sphericity from the batched eigvalsh eigenvalues against the old per event
+# np.linalg.eig, which only agree up to rounding
+def test_sphericity(events):
+    events = dict(events, Event_shapeEigenvalues=kernels.run_flat(
+        EventWide.calc_event_shape, events, EventWide.sphericity, []))
+    expected = kernels.run_builder(kernels.calc_sphericity, events,
+                                   EventWide.sphericity, [])
+    found = kernels.run_flat(EventWide.calc_sphericity, events, ["genWeight"],
+                             ["Event_shapeEigenvalues"])
+    assert ak.to_numpy(found) == pytest.approx(ak.to_numpy(expected), abs=3e-15)
+
+# Z vetoes of each flavour as they were before PairEngine
+@numba.jit(nopython=True)
+def in_zmass(lpt, leta, lphi, Lpt, Leta, Lphi):
+    delta = 15
+    zMass = 91.188
+    up = zMass + delta
+    down = zMass - delta
+    mass = 2*lpt*Lpt*(math.cosh(leta-Leta) - math.cos(lphi-Lphi))
+    return mass < 12**2 or (mass > down**2 and mass < up**2)
+
+@flat_kernel(np.bool_)
+def electron_zveto(pt, eCorr, eta, phi, charge, loose_idx, offsets, idx_offsets, out):
+    for ev in range(len(offsets) - 1):
+        passed = True
+        for idx in range(idx_offsets[ev], idx_offsets[ev+1]):
+            i = offsets[ev] + loose_idx[idx]
+            pt_i = pt[i]/eCorr[i]
+            for j in range(offsets[ev], offsets[ev+1]):
+                if charge[i]*charge[j] > 0:
+                    continue
+                pt_j = pt[j]/eCorr[j]
+                if in_zmass(pt_i, eta[i], phi[i], pt_j, eta[j], phi[j]):
+                    passed = False
+                    break
+            if not passed:
+                break
+        out[ev] = passed
+
+@flat_kernel(np.bool_)
+def muon_zveto(pt, eta, phi, charge, loose_idx, offsets, idx_offsets, out):
+    for ev in range(len(offsets) - 1):
+        passed = True
+        for idx in range(idx_offsets[ev], idx_offsets[ev+1]):
+            i = offsets[ev] + loose_idx[idx]
+            for j in range(offsets[ev], offsets[ev+1]):
+                if charge[i]*charge[j] > 0:
+                    continue
+                if in_zmass(pt[i], eta[i], phi[i], pt[j], eta[j], phi[j]):
+                    passed = False
+                    break
+            if not passed:
+                break
+        out[ev] = passed
+
+def test_zveto(events):
+    np.random.seed(15)
+    events = dict(events)
+    for coll in ["Electron", "Muon"]:
+        pt = events[coll+"_pt"]
+        selected = ak.unflatten(np.random.random(ak.count(pt)) < 0.6, ak.num(pt))
+        events[coll+"_looseIndex"] = ak.local_index(pt)[selected]
+    electron = kernels.run_flat(electron_zveto, events, pre("Electron", [
+        "pt", "eCorr", "eta", "phi", "charge"]), ["Electron_looseIndex"])
+    muon = kernels.run_flat(muon_zveto, events, pre("Muon", ["pt", "eta", "phi", "charge"]),
+                            ["Muon_looseIndex"])
+    expected = ak.to_numpy(electron) & ak.to_numpy(muon)
+    assert not expected.all()
+    assert np.array_equal(ak.to_numpy(EventWide.pass_zveto(events)), expected)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# Run from the top directory: python -m pytest tests
+# Runs create and apply through run.py on small random NanoAOD files, once
+# on the default path and once per option, and checks every option gives
+# the same selected events, outputs, cutflows and histograms.
+
+import os
+import sys
+import json
+import subprocess
+import numpy as np
+import awkward1 as ak
+import uproot4 as uproot
+import pytest
+
+top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+samples = {"ttt": (3000, 1), "ttbar": (2000, 2)}
+channels = ["SS", "OS"]
+
+def jagged(counts, content):
+    return ak.unflatten(content, counts)
+
+def make_collection(rng, counts, variables):
+    total = counts.sum()
+    return ak.zip({var: jagged(counts, maker(rng, total))
+                   for var, maker in variables.items()})
+
+def uniform(low, high, dtype=np.float32):
+    return lambda rng, n: rng.uniform(low, high, n).astype(dtype)
+
+def choice(values, dtype, p=None):
+    return lambda rng, n: rng.choice(values, n, p=p).astype(dtype)
+
+def make_events(nevents, seed):
+    rng = np.random.default_rng(seed)
+    events = dict()
+    common = {"pt": uniform(10, 150), "eta": uniform(-2.4, 2.4),
+              "phi": uniform(-np.pi, np.pi), "mass": uniform(0, 0.2),
+              "charge": choice([-1, 1], np.int32), "dxy": uniform(-0.02, 0.02),
+              "dz": uniform(-0.05, 0.05), "sip3d": uniform(0, 5),
+              "miniPFRelIso_all": uniform(0, 0.15)}
+    events["Electron"] = make_collection(rng, rng.integers(0, 4, nevents), dict(
+        common, convVeto=choice([True, False], np.bool_, [0.95, 0.05]),
+        lostHits=choice([0, 1], np.uint8, [0.9, 0.1]),
+        tightCharge=choice([0, 2], np.int32, [0.1, 0.9]),
+        eCorr=uniform(0.95, 1.05), mvaSpring16GP=uniform(0, 1),
+        dr03EcalRecHitSumEt=uniform(0, 3), dr03HcalDepth1TowerSumEt=uniform(0, 2),
+        dr03TkSumPt=uniform(0, 2), sieie=uniform(0, 0.02), hoe=uniform(0, 0.1),
+        eInvMinusPInv=uniform(-0.01, 0.01)))
+    events["Muon"] = make_collection(rng, rng.integers(0, 4, nevents), dict(
+        common, isGlobal=choice([True, False], np.bool_, [0.9, 0.1]),
+        isTracker=choice([True, False], np.bool_, [0.9, 0.1]),
+        isPFcand=choice([True, False], np.bool_, [0.95, 0.05]),
+        mediumId=choice([True, False], np.bool_, [0.9, 0.1]),
+        tightCharge=choice([0, 2], np.int32, [0.1, 0.9])))
+    events["Jet"] = make_collection(rng, rng.integers(0, 9, nevents), {
+        "pt": uniform(20, 300), "eta": uniform(-3, 3), "phi": uniform(-np.pi, np.pi),
+        "mass": uniform(0, 30), "btagDeepB": uniform(0, 1),
+        "jetId": choice([0, 2, 6], np.int32, [0.05, 0.15, 0.8])})
+    gen_counts = rng.integers(1, 12, nevents)
+    events["GenPart"] = make_collection(rng, gen_counts, {
+        "pdgId": choice([24, -24, 11, -11, 13, -13, 15, 12, 14, 16, 5, 21], np.int32),
+        "status": choice([1, 22, 52], np.int32)})
+    mother = np.concatenate([rng.integers(-1, count, count) for count in gen_counts])
+    events["GenPart"]["genPartIdxMother"] = jagged(gen_counts, mother.astype(np.int32))
+
+    events["MET_pt"] = uniform(0, 200)(rng, nevents)
+    events["MET_phi"] = uniform(-np.pi, np.pi)(rng, nevents)
+    events["Pileup_nTrueInt"] = uniform(0, 60)(rng, nevents)
+    events["genWeight"] = choice([-1., 1.], np.float32, [0.1, 0.9])(rng, nevents)
+    for flag in ["goodVertices", "globalSuperTightHalo2016Filter", "HBHENoiseFilter",
+                 "HBHENoiseIsoFilter", "EcalDeadCellTriggerPrimitiveFilter",
+                 "BadPFMuonFilter", "ecalBadCalibFilter"]:
+        events["Flag_" + flag] = rng.random(nevents) < 0.99
+    for trigger in ["DoubleMu8_Mass8_PFHT300", "Mu8_Ele8_CaloIdM_TrackIdM_Mass8_PFHT300",
+                    "DoubleEle8_CaloIdM_TrackIdM_Mass8_PFHT300", "AK8PFJet450",
+                    "PFJet450"]:
+        events["HLT_" + trigger] = rng.random(nevents) < 0.8
+    return events
+
+def write_events(filename, events, basket=500):
+    nevents = len(events["MET_pt"])
+    with uproot.recreate(filename) as outfile:
+        outfile.mktree("Events", {name: ak.type(array) if isinstance(array, ak.Array)
+                                  else array.dtype for name, array in events.items()})
+        for start in range(0, nevents, basket):
+            outfile["Events"].extend({name: array[start:start+basket]
+                                      for name, array in events.items()})
+
+@pytest.fixture(scope="module")
+def workspace(tmp_path_factory):
+    if not hasattr(uproot, "recreate"):
+        pytest.skip("uproot4 can not write ROOT files")
+    base = tmp_path_factory.mktemp("flags")
+    adm = base / "adm"
+    for subdir in ["PlotGroups", "FileInfo/montecarlo", "FileInfo/ThreeTop"]:
+        (adm / subdir).mkdir(parents=True)
+    files = dict()
+    for sample, (nevents, seed) in samples.items():
+        files[sample] = {"file_path": str(base / "{}.root".format(sample))}
+        write_events(files[sample]["file_path"], make_events(nevents, seed))
+    (adm / "PlotGroups" / "ThreeTop.py").write_text("info = {}\n")
+    # One sample split over two files, read with a glob
+    (base / "split").mkdir()
+    events = make_events(*samples["ttt"])
+    for idx, (start, stop) in enumerate([(0, 1500), (1500, 3000)]):
+        write_events(str(base / "split" / "split{}.root".format(idx)),
+                     {name: array[start:stop] for name, array in events.items()})
+    (adm / "FileInfo" / "montecarlo" / "montecarlo_2016.py").write_text(
+        "info = {}\n".format(dict({sample: {"cross_section": 0.1*(idx + 1)}
+                                   for idx, sample in enumerate(samples)},
+                                  split={"cross_section": 0.1})))
+    (adm / "FileInfo" / "ThreeTop" / "Smoke.py").write_text(
+        "info = {}\n".format(files))
+    (adm / "FileInfo" / "ThreeTop" / "Split.py").write_text(
+        "info = {}\n".format({"split": {"file_path": str(base / "split" / "*.root")}}))
+    return base
+
+def run(workspace, outdir, proc_type, *options, selection="Smoke", names=samples):
+    env = dict(os.environ, ADM_PATH=str(workspace / "adm"))
+    command = [sys.executable, "run.py", proc_type, "-o", str(workspace / outdir),
+               "-a", "ThreeTop", "-s", selection, "-f", ",".join(names),
+               "-c", ",".join(channels)] + list(options)
+    result = subprocess.run(command, cwd=top_dir, env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, universal_newlines=True)
+    assert result.returncode == 0, result.stdout
+    assert "Traceback" not in result.stdout, result.stdout
+    return result.stdout
+
+def read_outputs(workspace, outdir, names=samples):
+    outputs = dict()
+    for sample in names:
+        for channel in channels:
+            name = str(workspace / outdir / "{}_{}_cut".format(sample, channel))
+            with open(name + "flow.json") as f:
+                cutflow = json.load(f)
+            hists = np.load(name + "_hists.npz")
+            outputs[(sample, channel)] = {
+                "output": ak.to_list(ak.from_parquet(name + ".parquet")),
+                "entries": np.load(name + "entries.npy").tolist(),
+                "cutflow": cutflow,
+                "hists": {key: hists[key] for key in hists.files}}
+    return outputs
+
+@pytest.fixture(scope="module")
+def default(workspace):
+    run(workspace, "default", "all")
+    outputs = read_outputs(workspace, "default")
+    assert sum(len(output["entries"]) for output in outputs.values()) > 0
+    return outputs
+
+def compare(outputs, default):
+    for key, expected in default.items():
+        found = outputs[key]
+        assert found["entries"] == expected["entries"], key
+        assert found["output"] == expected["output"], key
+        assert found["cutflow"]["cuts"] == expected["cutflow"]["cuts"], key
+        assert found["cutflow"]["events"] == expected["cutflow"]["events"], key
+        assert (found["cutflow"]["weighted"] ==
+                pytest.approx(expected["cutflow"]["weighted"])), key
+        for name, hist in expected["hists"].items():
+            assert found["hists"][name] == pytest.approx(hist), (key, name)
+
+options = {
+    "fused": ["--fused"],
+    "stream": ["--stream"],
+    "job_threads": ["--fused", "--job-threads", "3"],
+    "process": ["--backend", "process", "-j", "2"],
+    "shards": ["--shard-size", "1000"],
+    "small_shards": ["--shard-size", "100"],
+    "stream_shards": ["--stream", "--shard-size", "100", "--memory-budget", "1",
+                      "--prefetch", "2"],
+    "preskim": ["--prune", "--preskim"],
+    "stream_preskim": ["--stream", "--preskim", "--pack-masks"],
+    "thread_preskim": ["--fused", "--job-threads", "3", "--preskim"],
+    "prefetch": ["--prefetch", "2"],
+    "memory_budget": ["--memory-budget", "1"],
+    "stream_budget": ["--stream", "--memory-budget", "1", "--prefetch", "2"],
+    "pack_masks": ["--pack-masks"],
+}
+
+@pytest.mark.parametrize("name", list(options))
+def test_option(workspace, default, name):
+    run(workspace, name, "all", *options[name])
+    compare(read_outputs(workspace, name), default)
+
+def test_incremental(workspace, default):
+    run(workspace, "incremental", "create", "--prune")
+    log = run(workspace, "incremental", "create", "--incremental")
+    assert "Updating jobs" in log
+    run(workspace, "incremental", "apply")
+    compare(read_outputs(workspace, "incremental"), default)
+
+def test_cache(workspace, default):
+    cache = str(workspace / "cache")
+    run(workspace, "cache_cold", "all", "--cache-dir", cache)
+    compare(read_outputs(workspace, "cache_cold"), default)
+    log = run(workspace, "cache_warm", "all", "--cache-dir", cache)
+    assert "Cached jobs: 0 of" not in log
+    compare(read_outputs(workspace, "cache_warm"), default)
+
+def test_cache_files(workspace):
+    # Each file of a globbed sample has its own cache entries
+    cache = str(workspace / "cache_files")
+    split = dict(selection="Split", names=["split"])
+    run(workspace, "split", "all", **split)
+    expected = read_outputs(workspace, "split", ["split"])
+    log = run(workspace, "split_cold", "all", "--cache-dir", cache, **split)
+    assert log.count("Cached jobs: 0 of") == 2
+    compare(read_outputs(workspace, "split_cold", ["split"]), expected)
+
+    filename = str(workspace / "split" / "split1.root")
+    events = make_events(*samples["ttt"])
+    write_events(filename, {name: array[1500:] for name, array in events.items()})
+    log = run(workspace, "split_warm", "all", "--cache-dir", cache, **split)
+    assert log.count("Cached jobs: 0 of") == 1
+    compare(read_outputs(workspace, "split_warm", ["split"]), expected)